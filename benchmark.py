@@ -0,0 +1,323 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from argparse import SUPPRESS, ArgumentParser
+
+import cv2 as cv
+import numpy as np
+
+from mylogger import logger
+
+default_data_dir = os.path.join('..', 'hecate-bench')
+
+# synthetic videos: resolution, length, frames per shot, crossfade frames between shots (0 for hard cuts),
+# and whether some shots are frozen (static) or blacked out
+SCENARIOS = {
+    'short_360p': dict(width=640, height=360, nframes=300, shot_len=75, fade=0, static=False),
+    'dense_cuts_360p': dict(width=640, height=360, nframes=900, shot_len=20, fade=0, static=False),
+    'fades_static_360p': dict(width=640, height=360, nframes=900, shot_len=120, fade=24, static=True),
+    'long_240p': dict(width=426, height=240, nframes=4500, shot_len=150, fade=12, static=True),
+    'hd_720p': dict(width=1280, height=720, nframes=450, shot_len=90, fade=15, static=True),
+}
+
+
+def make_scene(rng, width, height):
+    base = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    scene = cv.resize(base, (width, height), interpolation=cv.INTER_CUBIC)
+    for _ in range(8):
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv.circle(scene, center, int(rng.integers(5, max(6, height // 3))), color, -1)
+    return scene
+
+
+def make_video(path, width, height, nframes, shot_len, fade, static, fps=30.0, seed=0):
+    """
+    Write a video of random scenes cut every shot_len frames (crossfaded over fade frames), panning slowly with a
+    moving box. With static, every third shot is frozen and every fifth is almost black.
+    """
+    rng = np.random.default_rng(seed)
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    assert writer.isOpened(), f'Cannot write {path}'
+    nshots = (nframes + shot_len - 1) // shot_len
+    scenes = [make_scene(rng, width, height) for _ in range(nshots + 1)]
+    box = max(4, height // 8)
+
+    def render(shot, t):
+        if static and shot % 5 == 4:
+            return np.full((height, width, 3), 4, dtype=np.uint8)
+        if static and shot % 3 == 2:
+            t = 0
+        frame = np.roll(scenes[shot], t * max(1, width // 320), axis=1)
+        x = (shot * 97 + t * 3) % max(1, width - box)
+        y = (shot * 53 + t * 2) % max(1, height - box)
+        cv.rectangle(frame, (x, y), (x + box, y + box), (255, 255, 255), -1)
+        return frame
+
+    for i in range(nframes):
+        shot, t = divmod(i, shot_len)
+        frame = render(shot, t)
+        if fade > 0 and t >= shot_len - fade and shot + 1 < nshots:
+            alpha = (t - (shot_len - fade) + 1) / (fade + 1)
+            frame = cv.addWeighted(frame, 1.0 - alpha, render(shot + 1, 0), alpha, 0)
+        writer.write(frame)
+    writer.release()
+
+
+def make_chat(path, duration, density=2.0, npeaks=5, seed=0):
+    """
+    Write a chat.json with density messages per second, half spread uniformly and half around a few peaks.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * density)
+    peaks = rng.uniform(0, duration, npeaks)
+    times = np.concatenate([rng.uniform(0, duration, n - n // 2),
+                            rng.choice(peaks, n // 2) + rng.normal(0, 2.0, n // 2)])
+    times = np.clip(times, 0, duration)
+    chats = [{'text': f'chat {i}', 'time': float(t), 'send_time': 0} for i, t in enumerate(np.sort(times))]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(chats, f, ensure_ascii=False)
+
+
+def prepare(data_dir, name):
+    """
+    Generate the video and chat of a scenario unless they exist for the same spec, return the video path.
+    """
+    spec = SCENARIOS[name]
+    out_dir = os.path.join(data_dir, name)
+    video_path = os.path.join(out_dir, 'video.mp4')
+    spec_path = os.path.join(out_dir, 'spec.json')
+    if os.path.exists(video_path) and os.path.exists(spec_path):
+        with open(spec_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == spec:
+                return video_path
+
+    logger.info(f'Generating {name}: {spec}')
+    os.makedirs(out_dir, exist_ok=True)
+    make_video(video_path, **spec)
+    make_chat(os.path.join(out_dir, 'chat.json'), spec['nframes'] / 30.0)
+    if os.path.exists(os.path.join(out_dir, 'chat.idx')):
+        os.remove(os.path.join(out_dir, 'chat.idx'))
+    with open(spec_path, 'w', encoding='utf-8') as f:
+        json.dump(spec, f)
+    return video_path
+
+
+def anon_rss_mb():
+    """
+    Anonymous resident memory of this process in MB, 0 where /proc is not available. Unlike ru_maxrss, pages of
+    memory-mapped files (spilled frames) are not counted.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class AnonPeak:
+    """
+    Anonymous RSS when the context is entered and the highest seen while it is open, sampled every interval seconds
+    by a background thread (the kernel keeps no peak for it).
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start_mb = 0.0
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='anon-rss', daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak_mb = max(self.peak_mb, anon_rss_mb())
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.start_mb = self.peak_mb = anon_rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_once(video_path, hecate_args):
+    """
+    Run the whole pipeline on one video in this process and return its measurements.
+    """
+    import config
+    import func
+    import thumnail_extraction
+    from frames import FrameStore
+    from video_parser import VideoParser
+
+    opt = config.HecateParams(hecate_args + ['-f', video_path])
+    func.stage_timings.clear()
+    with AnonPeak() as anon:
+        start = time.time()
+        parser = VideoParser()
+        v_shot_range = parser.parse_video(opt)
+        v_thumb_idx = thumnail_extraction.detect_thumbnail_frames(
+            opt=opt, meta=parser.meta, v_shot_range=v_shot_range,
+            feature=parser.feature, diff=parser.X_diff, chat_scores=parser.chat_scores)
+        thumnail_extraction.generate_thumbnails(opt=opt, v_thumb_idx=v_thumb_idx)
+        total = time.time() - start
+    frame_list = parser.frame_list if isinstance(parser.frame_list, FrameStore) else None
+
+    return {
+        'nframes': parser.meta.nframes,
+        'resolution': [parser.meta.width, parser.meta.height],
+        'seconds': total,
+        'fps': parser.meta.nframes / total,
+        'stages': dict(func.stage_timings),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'start_anon_mb': anon.start_mb,
+        'peak_anon_mb': anon.peak_mb,
+        'frames_mb': len(frame_list) * int(np.prod(frame_list.shape)) / 2 ** 20 if frame_list is not None else 0.0,
+        'spilled': frame_list is not None and frame_list.spilled,
+        'frames': [int(i) for i in v_thumb_idx[:opt.njpg]],
+    }
+
+
+def run_scenario(video_path, hecate_args, repeat):
+    """
+    Measure a scenario in fresh interpreters, so peak RSS and caches are per run; keep the fastest run.
+    """
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', video_path, *hecate_args],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run['seconds'])
+    best['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+    best['peak_anon_mb'] = max(run['peak_anon_mb'] for run in runs)
+    best['runs'] = [run['seconds'] for run in runs]
+    return best
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'opencv': cv.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Log each scenario against the baseline, return the names of the scenarios that got slower than tolerance allows.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        ratio = result['seconds'] / base['seconds']
+        rss_ratio = result['peak_rss_mb'] / base['peak_rss_mb']
+        logger.info(f'{name}: {result["seconds"]:.3f}s vs {base["seconds"]:.3f}s ({ratio:.2f}x), '
+                    f'peak RSS {result["peak_rss_mb"]:.0f}MB vs {base["peak_rss_mb"]:.0f}MB ({rss_ratio:.2f}x)')
+        for stage, seconds in sorted(result['stages'].items()):
+            if stage in base['stages'] and base['stages'][stage] > 0:
+                logger.info(f'    {stage}: {seconds:.3f}s vs {base["stages"][stage]:.3f}s '
+                            f'({seconds / base["stages"][stage]:.2f}x)')
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+        if result['frames'] != base['frames']:
+            logger.warning(f'{name}: thumbnails changed from {base["frames"]} to {result["frames"]}')
+    return regressions
+
+
+def check_spill(name, result, spilled):
+    """
+    Log the anonymous RSS of a scenario run in memory and with its frames spilled to disk, return whether spilling
+    lowered it and kept its growth over the run below half the decoded frames' size. Per-frame state that stays in
+    memory (such as derived images held for every frame) fails the check even though the frames are on disk.
+    """
+    growth = spilled['peak_anon_mb'] - spilled['start_anon_mb']
+    logger.info(f'{name}: peak anonymous RSS {result["peak_anon_mb"]:.0f}MB in memory, '
+                f'{spilled["peak_anon_mb"]:.0f}MB spilled (+{growth:.0f}MB over the run), '
+                f'frames take {result["frames_mb"]:.0f}MB')
+    if not spilled['spilled'] or result['frames_mb'] == 0 or result['peak_anon_mb'] == 0:
+        logger.warning(f'{name}: frames were not spilled or memory is not measurable, spill check skipped')
+        return True
+    return spilled['peak_anon_mb'] < result['peak_anon_mb'] and growth <= 0.5 * result['frames_mb']
+
+
+def parse_args(args):
+    parser = ArgumentParser(description='Benchmark Hecate on synthetic videos, other arguments are passed to Hecate')
+    parser.add_argument('--data_dir', type=str, action='store', dest='data_dir', default=default_data_dir,
+                        help='Directory for the generated videos')
+    parser.add_argument('--scenarios', type=str, action='store', dest='scenarios', default=','.join(SCENARIOS),
+                        help='Comma separated scenarios to run')
+    parser.add_argument('--repeat', type=int, action='store', dest='repeat', default=1,
+                        help='Runs per scenario, the fastest one is reported')
+    parser.add_argument('-o', '--output', type=str, action='store', dest='output', default='benchmark.json',
+                        help='JSON file for the results')
+    parser.add_argument('--baseline', type=str, action='store', dest='baseline', default=None,
+                        help='Results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, action='store', dest='tolerance', default=0.1,
+                        help='Relative slowdown against the baseline reported as a regression')
+    parser.add_argument('--spill_check', action='store_true', dest='spill_check', default=False,
+                        help='Run each scenario again with --max_frame_ram 1 and fail unless spilling the decoded '
+                             'frames to disk lowers the peak anonymous RSS accordingly')
+    parser.add_argument('--run', type=str, action='store', dest='run', default=None, help=SUPPRESS)
+
+    return parser.parse_known_args(args)
+
+
+def benchmark(args):
+    opt, hecate_args = parse_args(args)
+    if opt.run is not None:
+        # child process measuring one video
+        logger.setLevel('WARNING')
+        print(json.dumps(run_once(opt.run, hecate_args)))
+        return 0
+
+    results = {}
+    not_freed = []
+    for name in opt.scenarios.split(','):
+        video_path = prepare(opt.data_dir, name)
+        results[name] = run_scenario(video_path, hecate_args, opt.repeat)
+        result = results[name]
+        logger.info(f'{name}: {result["nframes"]} frames in {result["seconds"]:.3f}s ({result["fps"]:.1f} fps), '
+                    f'peak RSS {result["peak_rss_mb"]:.0f}MB')
+        if opt.spill_check:
+            result['spill'] = run_scenario(video_path, hecate_args + ['--max_frame_ram', '1'], 1)
+            if not check_spill(name, result, result['spill']):
+                not_freed.append(name)
+
+    with open(opt.output, 'w', encoding='utf-8') as f:
+        json.dump({'environment': environment(), 'args': hecate_args, 'results': results}, f, indent=4)
+    logger.info(f'Results written to {opt.output}')
+
+    status = 0
+    if not_freed:
+        logger.warning(f'Anonymous RSS still grows with the frames when they are spilled: {", ".join(not_freed)}')
+        status = 1
+
+    if opt.baseline is not None:
+        with open(opt.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, opt.tolerance)
+        if regressions:
+            logger.warning(f'Slower than the baseline by more than {opt.tolerance:.0%}: {", ".join(regressions)}')
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    logger.setLevel('INFO')
+    sys.exit(benchmark(sys.argv[1:]))
@@ -0,0 +1,96 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from mylogger import logger
+
+CHAT_JSON = 'chat.json'
+CHAT_INDEX = 'chat.idx'
+
+# magic, format version, number of chats; followed by the chat times (seconds) as sorted little-endian float32
+_HEADER = struct.Struct('<4sIQ')
+_MAGIC = b'HCHT'
+_VERSION = 1
+
+
+def write_chat_index(path, chat_times):
+    chat_times = np.sort(np.asarray(chat_times, dtype='<f4'))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(chat_times)))
+        f.write(chat_times.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_chat_index(path):
+    """
+    Memory-map the chat times of an index written by write_chat_index.
+    """
+    with open(path, 'rb') as f:
+        magic, version, count = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError(f'{path} is not a chat index (version {_VERSION})')
+    if count == 0:
+        return np.zeros(shape=(0,), dtype='<f4')
+    return np.memmap(path, dtype='<f4', mode='r', offset=_HEADER.size, shape=(count,))
+
+
+def iter_json_array(f, chunk_size=1 << 16):
+    """
+    Yield the elements of the top level JSON array in f one by one, without loading the whole file.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    started = False
+    eof = False
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+            pos += 1
+        if not started and pos < len(buffer) and buffer[pos] == '[':
+            started = True
+            pos += 1
+            continue
+        if started and pos < len(buffer) and buffer[pos] == ']':
+            return
+        value, end = None, -1
+        if started and pos < len(buffer):
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise
+        # a value running up to the end of the buffer may continue in the next chunk
+        if end < 0 or (end == len(buffer) and not eof):
+            if eof:
+                raise ValueError(f'{getattr(f, "name", "input")} is not a complete JSON array')
+            chunk = f.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield value
+        pos = end
+
+
+def read_chat_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return np.array([chat['time'] for chat in iter_json_array(f)], dtype=np.float64)
+
+
+def load_chat_times(chat_dir):
+    """
+    Chat times (seconds) of the video in chat_dir, read from its chat index when that is present and not older
+    than chat.json, otherwise parsed from chat.json.
+    """
+    index_path = os.path.join(chat_dir, CHAT_INDEX)
+    json_path = os.path.join(chat_dir, CHAT_JSON)
+    if os.path.exists(index_path) and \
+            (not os.path.exists(json_path) or os.path.getmtime(index_path) >= os.path.getmtime(json_path)):
+        try:
+            return np.asarray(read_chat_index(index_path), dtype=np.float64)
+        except (ValueError, struct.error) as e:
+            logger.warning(f'Ignoring chat index {index_path}: {e}')
+    return read_chat_json(json_path)
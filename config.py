@@ -3,6 +3,11 @@ import os
 
 
 class HecateParams:
+    # options that change how a video is processed but not its thumbnails
+    RUNTIME_OPTIONS = ('video_file', 'out_dir', 'stream', 'workers', 'threads', 'max_frame_ram', 'cache_dir',
+                       'cache_size', 'profile', 'profile_format', 'profile_memory', 'batch_dir', 'batch_workers',
+                       'summary_file', 'force')
+
     def __init__(self, args):
         optparser = ArgumentParser()
         optparser.add_argument('-f', '--video_file', action='store', dest='video_file', default='video.mp4',
@@ -11,12 +16,78 @@ class HecateParams:
                                help='Number of thumbnails to be generated')
         optparser.add_argument('--invalid_wnd', action='store', dest='invalid_wnd', default=0.15,
                                help='Window for dropping neighbor frames of low-quality ones (seconds)')
+        optparser.add_argument('--stream', action='store_true', dest='stream', default=False,
+                               help='Analyse frames while decoding instead of keeping the whole video in memory')
+        optparser.add_argument('--analysis_width', action='store', dest='analysis_width', default=0,
+                               help='Downscale frames to this width for analysis, thumbnails keep the native '
+                                    'resolution (0 to analyse at native resolution)')
+        optparser.add_argument('--stride', action='store', dest='stride', default=1,
+                               help='Analyse every k-th frame only, skipped frames are not decoded')
+        optparser.add_argument('--analysis_fps', action='store', dest='analysis_fps', default=0,
+                               help='Target analysis frame rate, overrides --stride (0 to disable)')
+        optparser.add_argument('-j', '--workers', action='store', dest='workers', default=1,
+                               help='Number of worker processes for frame statistics and histogram features')
+        optparser.add_argument('--threads', action='store', dest='threads', default=0,
+                               help='Number of analysis threads; with --stream, also decode in a background thread '
+                                    '(0 to disable, ignored for analysis when --workers > 1)')
+        optparser.add_argument('--max_frame_ram', action='store', dest='max_frame_ram', default=0,
+                               help='Decoded frames beyond this size in MB are kept in a memory-mapped temporary '
+                                    'file instead of RAM (0 for no limit)')
+        optparser.add_argument('--cache_dir', action='store', dest='cache_dir', default='',
+                               help='Directory caching analysis results across runs (empty to disable)')
+        optparser.add_argument('--cache_size', action='store', dest='cache_size', default=2048,
+                               help='Size of the analysis cache in MB, least recently used entries are evicted')
+        optparser.add_argument('--profile', action='store', dest='profile', default='',
+                               help='Write a profile of nested stage timings to this file (empty to disable)')
+        optparser.add_argument('--profile_format', action='store', dest='profile_format', default='json',
+                               choices=['json', 'chrome'], help='Profile as a JSON summary or a Chrome trace')
+        optparser.add_argument('--profile_memory', action='store_true', dest='profile_memory', default=False,
+                               help='Also trace the peak Python allocations of every stage (slow)')
+        optparser.add_argument('--batch', action='store', dest='batch_dir', default='',
+                               help='Process every video.mp4 below this dataset directory instead of --video_file')
+        optparser.add_argument('--batch_workers', action='store', dest='batch_workers', default=1,
+                               help='Number of videos processed concurrently in batch mode')
+        optparser.add_argument('--summary', action='store', dest='summary_file', default='',
+                               help='JSONL file the batch results are appended to (default: <batch>/summary.jsonl)')
+        optparser.add_argument('--force', action='store_true', dest='force', default=False,
+                               help='In batch mode, also process videos whose thumbnails are up to date')
+        optparser.add_argument('--kmeans', action='store', dest='kmeans', default='exact',
+                               choices=['exact', 'subsample', 'minibatch'],
+                               help='Clustering of the frame features: exact k-means, k-means on a random subsample '
+                                    'with every frame assigned afterwards, or mini-batch k-means')
+        optparser.add_argument('--kmeans_batch', action='store', dest='kmeans_batch', default=1024,
+                               help='Rows per batch of mini-batch k-means and of the nearest-center assignment')
+        optparser.add_argument('--kmeans_samples', action='store', dest='kmeans_samples', default=8192,
+                               help='Maximum number of rows clustered by --kmeans subsample')
         opt = optparser.parse_known_args(args)[0]
+        if int(opt.kmeans_batch) < 1:
+            optparser.error('--kmeans_batch must be at least 1')
+        if int(opt.kmeans_samples) < 1:
+            optparser.error('--kmeans_samples must be at least 1')
 
         self.video_file = os.path.relpath(opt.video_file)
         self.out_dir = os.path.dirname(self.video_file)
         self.njpg = int(opt.njpg)
         self.invalid_wnd = float(opt.invalid_wnd)
+        self.stream = bool(opt.stream)
+        self.analysis_width = int(opt.analysis_width)
+        self.stride = int(opt.stride)
+        self.analysis_fps = float(opt.analysis_fps)
+        self.workers = int(opt.workers)
+        self.threads = int(opt.threads)
+        self.max_frame_ram = int(opt.max_frame_ram)
+        self.cache_dir = opt.cache_dir
+        self.cache_size = int(opt.cache_size)
+        self.profile = opt.profile
+        self.profile_format = opt.profile_format
+        self.profile_memory = bool(opt.profile_memory)
+        self.batch_dir = opt.batch_dir
+        self.batch_workers = int(opt.batch_workers)
+        self.summary_file = opt.summary_file
+        self.force = bool(opt.force)
+        self.kmeans = opt.kmeans
+        self.kmeans_batch = int(opt.kmeans_batch)
+        self.kmeans_samples = int(opt.kmeans_samples)
 
         self.chat_window = (-3.0, 7.0)
         self.chat_alpha = 1.0
@@ -10,6 +10,7 @@ from you_get import common
 from argparse import ArgumentParser
 
 from .config import get_headers
+from chat_index import CHAT_INDEX, CHAT_JSON, read_chat_json, write_chat_index
 from mylogger import logger
 
 
@@ -44,9 +45,9 @@ def craw_cover_chat(bv: str, output_dir: os.path) -> None:
         with open(cover_path, 'wb') as f:
             f.write(cover)
 
-    # download video chat and save it as a json file
+    # download video chat, save it as a json file and index its times
     chat_url = find_url(soup, '弹幕地址:')
-    chat_path = os.path.join(output_dir, 'chat.json')
+    chat_path = os.path.join(output_dir, CHAT_JSON)
     if not os.path.exists(chat_path):
         chat = requests.get(url=chat_url, headers=get_headers()).content
         soup = BeautifulSoup(chat, 'lxml', from_encoding='utf-8')
@@ -64,6 +65,10 @@ def craw_cover_chat(bv: str, output_dir: os.path) -> None:
             })
         with open(chat_path, 'w', encoding='utf-8') as f:
             json.dump(chat_list, f, ensure_ascii=False, indent=4)
+        write_chat_index(os.path.join(output_dir, CHAT_INDEX), [chat['time'] for chat in chat_list])
+    elif not os.path.exists(os.path.join(output_dir, CHAT_INDEX)):
+        # chat downloaded before the index existed
+        write_chat_index(os.path.join(output_dir, CHAT_INDEX), read_chat_json(chat_path))
 
 
 def check_dir(root_dir: os.path, name: str = None) -> os.path:
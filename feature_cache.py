@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from mylogger import logger
+
+_VERSION = 3
+_HASHES = 'hashes.json'
+_INFO = 'info.json'
+
+
+class FeatureCache:
+    """
+    Analysis results on disk, one directory per key holding a .npy file per array (memory-mapped on load) and a
+    JSON file for everything else. Least recently used entries are evicted once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, root, max_bytes=2 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def content_hash(self, path):
+        """
+        SHA-256 of the file content. Digests are remembered by path, size and mtime, so unchanged files are
+        hashed only once.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        hashes = self._read_json(os.path.join(self.root, _HASHES), {})
+        stamp = [st.st_size, st.st_mtime_ns]
+        if path in hashes and hashes[path][:2] == stamp:
+            return hashes[path][2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        hashes[path] = stamp + [digest]
+        self._write_json(os.path.join(self.root, _HASHES), hashes)
+        return digest
+
+    def key(self, files, params):
+        """
+        Cache key of the contents of files (missing ones count as empty) and the JSON-serializable params.
+        """
+        sha = hashlib.sha256(f'hecate-cache-{_VERSION}'.encode())
+        for path in files:
+            sha.update((self.content_hash(path) if os.path.exists(path) else '-').encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def load(self, key):
+        """
+        Return (arrays, info) stored under key, or None on a miss.
+        """
+        entry = os.path.join(self.root, key)
+        info = self._read_json(os.path.join(entry, _INFO), None)
+        if info is None:
+            return None
+        try:
+            arrays = {name: np.load(os.path.join(entry, f'{name}.npy'), mmap_mode='r') for name in info['arrays']}
+        except (OSError, ValueError) as e:
+            logger.warning(f'Dropping broken cache entry {key}: {e}')
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        os.utime(entry)     # mark as recently used
+        return arrays, info['info']
+
+    def store(self, key, arrays, info):
+        tmp = os.path.join(self.root, f'.tmp-{uuid.uuid4().hex}')
+        os.makedirs(tmp)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, f'{name}.npy'), np.ascontiguousarray(array), allow_pickle=False)
+            self._write_json(os.path.join(tmp, _INFO), {'arrays': list(arrays), 'info': info})
+            entry = os.path.join(self.root, key)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if not os.path.isdir(entry) or name.startswith('.'):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), name, size))
+            total += size
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            total -= size
+            logger.info(f'Evicted cache entry {name} ({size} bytes)')
+
+    @staticmethod
+    def _read_json(path, default):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    @staticmethod
+    def _write_json(path, value):
+        tmp = f'{path}.{os.getpid()}.{time.monotonic_ns()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
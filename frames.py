@@ -0,0 +1,307 @@
+import os
+import queue
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2 as cv
+import numpy as np
+
+
+class DerivedStats:
+    def __init__(self):
+        self.computed = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+
+    def add(self, computed, reused):
+        with self._lock:
+            self.computed += computed
+            self.reused += reused
+
+    def __str__(self):
+        return f'{self.computed} conversions computed, {self.reused} redundant conversions saved'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class FrameData:
+    """
+    Images derived from one decoded frame (blurred gray, HSV, Scharr gradients), each computed on first use and
+    shared by all analysis stages until release() evicts them. The plain gray image is only an intermediate of the
+    blurred one and is not kept.
+    """
+
+    def __init__(self, bgr, stats: DerivedStats = None):
+        self.bgr = bgr
+        self.stats = stats if stats is not None else DerivedStats()
+        self._blurred = None
+        self._hsv = None
+        self._gradients = None
+
+    def _count(self, cached):
+        if cached is None:
+            self.stats.add(1, 0)
+        else:
+            self.stats.add(0, 1)
+
+    def blurred(self):
+        self._count(self._blurred)
+        if self._blurred is None:
+            self._blurred = cv.GaussianBlur(cv.cvtColor(self.bgr, cv.COLOR_BGR2GRAY), (3, 3), 0)
+        return self._blurred
+
+    def hsv(self):
+        self._count(self._hsv)
+        if self._hsv is None:
+            self._hsv = cv.cvtColor(self.bgr, cv.COLOR_BGR2HSV)
+        return self._hsv
+
+    def gradients(self):
+        self._count(self._gradients)
+        if self._gradients is None:
+            blurred = self.blurred()
+            self._gradients = (cv.Scharr(blurred, cv.CV_32F, 1, 0), cv.Scharr(blurred, cv.CV_32F, 0, 1))
+        return self._gradients
+
+    def release(self):
+        self._blurred = None
+        self._hsv = None
+        self._gradients = None
+
+
+class SharedFrames:
+    """
+    A block of equally shaped uint8 frames in shared memory. The creator owns the block and unlinks it,
+    worker processes attach to it by name.
+    """
+
+    def __init__(self, shape, count, name=None):
+        size = count * int(np.prod(shape))
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.frames = np.ndarray((count, *shape), dtype=np.uint8, buffer=self.shm.buf)
+
+    def close(self, unlink=False):
+        # views on the buffer must be gone before it can be closed
+        self.frames = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class FrameStore:
+    """
+    Equally shaped uint8 frames with list-like indexing, kept in one (nframes, H, W, C) array. Once the frames
+    would take more than max_ram_bytes (0 for no limit) the array is moved to a np.memmap over an unlinked
+    temporary file, so large videos page through the OS cache instead of exhausting memory.
+    """
+
+    def __init__(self, shape, capacity=16, max_ram_bytes=0, spill_dir=None):
+        self.shape = tuple(shape)
+        self.max_ram_bytes = max_ram_bytes
+        self.spill_dir = spill_dir
+        self.file = None
+        self.count = 0
+        self.frames = None
+        self._allocate(max(1, capacity))
+
+    @property
+    def spilled(self):
+        return self.file is not None
+
+    def _allocate(self, capacity):
+        nbytes = capacity * int(np.prod(self.shape))
+        in_file = self.file is not None
+        if not in_file and 0 < self.max_ram_bytes < nbytes:
+            self.file = tempfile.TemporaryFile(prefix='hecate-frames-', dir=self.spill_dir)
+        if self.file is not None:
+            self.file.truncate(nbytes)
+            frames = np.asarray(np.memmap(self.file, dtype=np.uint8, mode='r+', shape=(capacity, *self.shape)))
+        else:
+            frames = np.empty((capacity, *self.shape), dtype=np.uint8)
+        # frames already in the file are seen by the new mapping
+        if self.count > 0 and not in_file:
+            frames[:self.count] = self.frames[:self.count]
+        self.frames = frames
+
+    def append(self, frame):
+        if self.count == len(self.frames):
+            self._allocate(2 * len(self.frames))
+        self.frames[self.count] = frame
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.frames[:self.count][index]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('frame index out of range')
+        return self.frames[index]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.frames[i]
+
+    def close(self):
+        self.frames = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def share_cv_threads(nworkers: int):
+    # OpenCV threads of a process running alongside nworkers - 1 others, so they share the cores
+    cv.setNumThreads(max(1, (os.cpu_count() or 1) // nworkers))
+
+
+def _init_worker():
+    # one OpenCV thread per process, the pool already uses every core
+    cv.setNumThreads(1)
+
+
+def _run_chunk(name, shape, count, job, args):
+    block = SharedFrames(shape, count, name)
+    stats = DerivedStats()
+    try:
+        results = [job(FrameData(block.frames[i], stats), *args) for i in range(count)]
+    finally:
+        block.close()
+    return results, stats.computed, stats.reused
+
+
+def _run_chunk_local(chunk, job, args):
+    return [job(data, *args) for data in chunk]
+
+
+class FramePool:
+    """
+    Maps a per-frame job over a sequence of FrameData, in chunks of frames spread over worker processes.
+    Frames reach the workers through shared memory, only the job results are pickled back. With threads=True
+    the chunks run on a thread pool instead, directly on the given FrameData (OpenCV releases the GIL).
+    With a single worker the job runs inline, so derived images stay cached for the caller.
+    """
+
+    def __init__(self, workers=1, chunk_size=32, stats: DerivedStats = None, threads=False):
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.stats = stats if stats is not None else DerivedStats()
+        self.threads = threads
+        self.executor = None
+        if self.workers > 1:
+            if threads:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            else:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+    def map(self, items, job, args=()):
+        """
+        Yield (FrameData, job(FrameData, *args)) for every item, in order. At most two chunks per worker are
+        in flight, so items may be a lazy generator over a decoding video.
+        """
+        if self.executor is None:
+            for data in items:
+                yield data, job(data, *args)
+            return
+
+        pending = deque()
+        try:
+            chunk = []
+            for data in items:
+                chunk.append(data)
+                if len(chunk) == self.chunk_size:
+                    pending.append(self._submit(chunk, job, args))
+                    chunk = []
+                if len(pending) >= 2 * self.workers:
+                    yield from self._collect(*pending.popleft())
+            if len(chunk) > 0:
+                pending.append(self._submit(chunk, job, args))
+            while pending:
+                yield from self._collect(*pending.popleft())
+        finally:
+            for _, block, future in pending:
+                future.cancel()
+                if block is not None:
+                    block.close(unlink=True)
+
+    def _submit(self, chunk, job, args):
+        if self.threads:
+            return chunk, None, self.executor.submit(_run_chunk_local, chunk, job, args)
+        block = SharedFrames(chunk[0].bgr.shape, len(chunk))
+        for i, data in enumerate(chunk):
+            block.frames[i] = data.bgr
+        future = self.executor.submit(_run_chunk, block.shm.name, chunk[0].bgr.shape, len(chunk), job, args)
+        return chunk, block, future
+
+    def _collect(self, chunk, block, future):
+        if block is None:
+            return zip(chunk, future.result())
+        try:
+            results, computed, reused = future.result()
+        finally:
+            block.close(unlink=True)
+        self.stats.add(computed, reused)
+        return zip(chunk, results)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(items, maxsize):
+    """
+    Iterate items in a background thread and yield its values through a queue bounded to maxsize entries,
+    so producing (e.g. decoding) the next values overlaps with consuming the current ones.
+    """
+    buffer = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                buffer.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(_END)
+        except BaseException as e:
+            put(_Failure(e))
+
+    producer = threading.Thread(target=produce, name='prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            value = buffer.get()
+            if value is _END:
+                break
+            if isinstance(value, _Failure):
+                raise value.error
+            yield value
+    finally:
+        stop.set()
+        producer.join()
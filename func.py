@@ -3,6 +3,7 @@ import numpy as np
 from typing import Tuple
 import time
 from mylogger import logger
+import profiler
 
 
 def gaussian_distribution(x: float, mu: float = 0.0, sigma: float = 1.0) -> float:
@@ -19,13 +20,19 @@ def normalize_pdf(pdf: np.ndarray) -> np.ndarray:
     return pdf / np.sum(pdf)
 
 
+# total seconds spent in each time_it stage of this process, by function name
+stage_timings = {}
+
+
 def time_it(func):
     def wrapper(*args, **kwargs):
         logger.info(f'Running {func.__name__}...')
         start = time.time()
-        result = func(*args, **kwargs)
+        with profiler.span(func.__name__):
+            result = func(*args, **kwargs)
         end = time.time()
         logger.info(f"Time taken by {func.__name__} is {end - start:.04f} seconds")
+        stage_timings[func.__name__] = stage_timings.get(func.__name__, 0.0) + end - start
         return result
     return wrapper
 
@@ -48,8 +55,142 @@ def hecate_sort(unsorted: list) -> Tuple[list, list]:
     return reorder(unsorted, index_map), index_map
 
 
+def find_runs(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    First and last index of every run of True in a 1-D boolean mask.
+    """
+    edges = np.diff(np.concatenate([[0], np.asarray(mask, dtype=np.int8), [0]]))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+
+
+def runs_mask(starts: np.ndarray, ends: np.ndarray, size: int) -> np.ndarray:
+    """
+    Boolean mask of length size, True inside the disjoint ranges [starts[i], ends[i]].
+    """
+    delta = np.zeros(size + 1, dtype=np.int32)
+    np.add.at(delta, starts, 1)
+    np.add.at(delta, np.asarray(ends) + 1, -1)
+    return np.cumsum(delta[:size]) > 0
+
+
+def segment_argmin(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Index of the first minimum of values within each non-empty range [starts[i], ends[i]].
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - starts + 1
+    if len(lengths) == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    v_idx = np.arange(lengths.sum()) - offsets[segment] + starts[segment]
+    # sorted by segment, then value, then index: the first entry of each segment is its minimum
+    order = np.lexsort((v_idx, np.asarray(values)[v_idx], segment))
+    return v_idx[order[offsets]]
+
+
+def assign_clusters(km_data: np.ndarray, km_ctr: np.ndarray, batch_size: int = 4096) -> np.ndarray:
+    """
+    Label of the nearest center for every row, as an (n, 1) int32 array. Distances are computed batch_size rows at a
+    time, so memory stays at batch_size x k.
+    """
+    ctr_sq = np.sum(km_ctr * km_ctr, axis=1)
+    km_lbl = np.zeros(shape=(km_data.shape[0], 1), dtype=np.int32)
+    for b in range(0, km_data.shape[0], batch_size):
+        # |x - c|^2 without the |x|^2 term, which is the same for every center
+        dist = ctr_sq[None, :] - 2 * km_data[b:b + batch_size] @ km_ctr.T
+        km_lbl[b:b + batch_size, 0] = np.argmin(dist, axis=1)
+    return km_lbl
+
+
+def reseed_empty_clusters(km_data: np.ndarray, km_lbl: np.ndarray, km_ctr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Give every empty cluster the row farthest from its own center, taken from a cluster of more than one row, as
+    cv2.kmeans does. Duplicate rows give duplicate centers, and the nearest-center assignment sends all of them to
+    the first one, so the approximate backends can otherwise return fewer non-empty clusters than requested.
+    """
+    counts = np.bincount(km_lbl[:, 0], minlength=km_ctr.shape[0])
+    if np.all(counts > 0):
+        return km_lbl, km_ctr
+    dist = np.sum(np.square(km_data - km_ctr[km_lbl[:, 0]], dtype=np.float64), axis=1)
+    for k in np.flatnonzero(counts == 0):
+        # rows of singleton clusters cannot move, ties go to the first row
+        far = int(np.argmax(np.where(counts[km_lbl[:, 0]] > 1, dist, -1.0)))
+        counts[km_lbl[far, 0]] -= 1
+        counts[k] = 1
+        km_lbl[far, 0] = k
+        km_ctr[k] = km_data[far]
+        dist[far] = 0.0
+    return km_lbl, km_ctr
+
+
+def _kmeans_exact(km_data, km_k, km_attempts, km_opt, km_seed, batch_size, max_samples):
+    # k-means++ draws from OpenCV's per-thread RNG, reseed it so results do not depend on earlier calls
+    cv2.setRNGSeed(km_seed)
+    compactness, km_lbl, km_ctr = cv2.kmeans(
+        data=km_data, K=km_k, criteria=km_opt, bestLabels=None, attempts=km_attempts, flags=cv2.KMEANS_PP_CENTERS)
+    return km_lbl, km_ctr
+
+
+def _kmeans_subsample(km_data, km_k, km_attempts, km_opt, km_seed, batch_size, max_samples):
+    # k-means needs at least one row per cluster
+    nsamples = max(max_samples, km_k)
+    if km_data.shape[0] <= nsamples:
+        return _kmeans_exact(km_data, km_k, km_attempts, km_opt, km_seed, batch_size, max_samples)
+    rng = np.random.default_rng(km_seed)
+    sample = np.sort(rng.choice(km_data.shape[0], size=nsamples, replace=False))
+    _, km_ctr = _kmeans_exact(km_data[sample], km_k, km_attempts, km_opt, km_seed, batch_size, max_samples)
+    return reseed_empty_clusters(km_data, assign_clusters(km_data, km_ctr, batch_size), km_ctr)
+
+
+def _kmeans_minibatch(km_data, km_k, km_attempts, km_opt, km_seed, batch_size, max_samples):
+    n = km_data.shape[0]
+    rng = np.random.default_rng(km_seed)
+    # k-means++ on a first batch, then every center moves to the running mean of the samples assigned to it
+    init = np.sort(rng.choice(n, size=min(n, max(batch_size, 3 * km_k)), replace=False))
+    init_opt = (cv2.TermCriteria_MAX_ITER | cv2.TermCriteria_EPS, 1, km_opt[2])
+    _, km_ctr = _kmeans_exact(km_data[init], km_k, km_attempts, init_opt, km_seed, batch_size, max_samples)
+    counts = np.zeros(km_k, dtype=np.float64)
+    # about five passes over the data, fewer if the centers stop moving
+    niter = min(km_opt[1], max(10, 5 * -(-n // batch_size)))
+    for _ in range(niter):
+        batch = km_data[rng.integers(0, n, size=min(n, batch_size))]
+        lbl = assign_clusters(batch, km_ctr, batch_size)[:, 0]
+        nassigned = np.bincount(lbl, minlength=km_k)
+        members = np.zeros(shape=(km_k, len(batch)), dtype=batch.dtype)
+        members[lbl, np.arange(len(batch))] = 1
+        sums = (members @ batch).astype(np.float64)
+        counts += nassigned
+        moved = nassigned > 0
+        step = (sums[moved] - nassigned[moved, None] * km_ctr[moved]) / counts[moved, None]
+        km_ctr[moved] += step.astype(km_ctr.dtype)
+        if np.max(np.sum(step * step, axis=1), initial=0.0) <= km_opt[2] * km_opt[2]:
+            break
+    return reseed_empty_clusters(km_data, assign_clusters(km_data, km_ctr, batch_size), km_ctr)
+
+
+# clustering backends of perform_kmeans by name
+KMEANS_METHODS = {
+    'exact': _kmeans_exact,
+    'subsample': _kmeans_subsample,
+    'minibatch': _kmeans_minibatch,
+}
+
+
 def perform_kmeans(km_data: np.ndarray, ncluster: int, km_attempts: int = 1,
-                   km_max_cnt: int = 1000, km_eps: float = 0.0001) -> Tuple[np.ndarray, np.ndarray]:
+                   km_max_cnt: int = 1000, km_eps: float = 0.0001, km_seed: int = 1, method: str = 'exact',
+                   batch_size: int = 1024, max_samples: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cluster the rows of km_data into ncluster clusters, returning (n, 1) labels and the centers.
+
+    method picks the backend. 'exact' runs cv2.kmeans with k-means++ on all rows. 'subsample' runs it on at most
+    max(max_samples, ncluster) random rows and assigns every row to the nearest of the resulting centers. 'minibatch'
+    updates the centers from random batches of batch_size rows (Sculley's mini-batch k-means, about five
+    passes over the data at most). The approximate backends cost O(max_samples) and O(passes x n) distance
+    computations instead of O(iterations x n), and their working memory is bounded by the sample or batch
+    size. In exchange, clusters may differ from exact k-means, mostly for small or close clusters. Like the exact
+    backend, they return no empty cluster.
+    """
     if km_data.shape[0] == 1:
         km_k = 1
         km_lbl = np.zeros(shape=(1, 1), dtype=np.int32)
@@ -58,13 +199,14 @@ def perform_kmeans(km_data: np.ndarray, ncluster: int, km_attempts: int = 1,
     else:
         km_k = min(ncluster, km_data.shape[0])
         km_opt = (cv2.TermCriteria_MAX_ITER | cv2.TermCriteria_EPS, km_max_cnt, km_eps)
-        logger.debug(f'K-means data shape: {km_data.shape}')
-        compactness, km_lbl, km_ctr = cv2.kmeans(
-            data=km_data, K=km_k, criteria=km_opt, bestLabels=None,
-            attempts=km_attempts, flags=cv2.KMEANS_PP_CENTERS)
-
-    logger.debug(f'K-means: {km_k} clusters, km_lbl.shape={km_lbl.shape}, km_ctr.shape={km_ctr.shape}')
-    logger.debug(f'K-means: km_lbl={km_lbl}, km_ctr={km_ctr}')
+        logger.debug('K-means data shape: %s, method: %s', args=(km_data.shape, method))
+        with profiler.span('kmeans'):
+            km_lbl, km_ctr = KMEANS_METHODS[method](km_data, km_k, km_attempts, km_opt, km_seed, batch_size,
+                                                    max_samples)
+        profiler.count('kmeans_samples', km_data.shape[0])
+
+    logger.debug('K-means: %d clusters, km_lbl.shape=%s, km_ctr.shape=%s', args=(km_k, km_lbl.shape, km_ctr.shape))
+    logger.debug('K-means: km_lbl=%s, km_ctr=%s', args=(km_lbl, km_ctr))
 
     return km_lbl, km_ctr
 
@@ -1,32 +1,159 @@
+import json
 import os.path
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import config
 import func
 import video_parser
 import thumnail_extraction
+from chat_index import CHAT_INDEX, CHAT_JSON
+from frames import share_cv_threads
 from mylogger import logger
+import profiler
 from video_parser import *
 
 from mylogger import logger
 from crawler import craw_bilibili
 
 
-def hecate(opt: config.HecateParams):
+def hecate(opt: config.HecateParams, timings: dict = None):
+    if opt.profile:
+        profiler.enable(memory=opt.profile_memory)
+        try:
+            with profiler.span('hecate'):
+                return _hecate(opt, timings)
+        finally:
+            profiler.disable().write(opt.profile, opt.profile_format)
+            logger.info(f'Profile written to {opt.profile}')
+    return _hecate(opt, timings)
+
+
+def _hecate(opt: config.HecateParams, timings: dict = None):
     logger.info(f'Hecate parameters: {opt}')
+    timings = timings if timings is not None else {}
 
+    start = time.time()
     parser = VideoParser()
     v_shot_range = parser.parse_video(opt)
+    timings['parse_video'] = time.time() - start
 
-    logger.debug(f'v_shot_range: {v_shot_range}')
+    logger.debug('v_shot_range: %s', args=(v_shot_range,))
 
+    start = time.time()
     v_thumb_idx = thumnail_extraction.detect_thumbnail_frames(
         opt=opt, meta=parser.meta, v_shot_range=v_shot_range,
         feature=parser.feature, diff=parser.X_diff, chat_scores=parser.chat_scores)
+    timings['detect_thumbnail_frames'] = time.time() - start
 
+    start = time.time()
     thumnail_extraction.generate_thumbnails(opt=opt, v_thumb_idx=v_thumb_idx)
+    timings['generate_thumbnails'] = time.time() - start
+
+    return v_thumb_idx
+
+
+BATCH_MARKER = '.hecate.json'
+
+
+def discover_videos(root_dir: str) -> list:
+    """
+    Every video.mp4 below root_dir (the crawler saves videos as <root>/<BV>/video.mp4), sorted by path.
+    """
+    videos = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = sorted(d for d in dirnames if d != 'thumbnails')
+        if 'video.mp4' in filenames:
+            videos.append(os.path.join(dirpath, 'video.mp4'))
+    return videos
+
+
+def thumbnail_options(opt: config.HecateParams) -> dict:
+    options = {key: value for key, value in vars(opt).items() if key not in config.HecateParams.RUNTIME_OPTIONS}
+    # as read back from JSON, e.g. tuples become lists
+    return json.loads(json.dumps(options))
+
+
+def thumbnails_up_to_date(opt: config.HecateParams) -> bool:
+    """
+    Whether the thumbnails of opt.video_file were generated with the same options after its video and chat last
+    changed.
+    """
+    marker = os.path.join(opt.out_dir, 'thumbnails', BATCH_MARKER)
+    if not os.path.exists(marker):
+        return False
+    inputs = [opt.video_file] + [os.path.join(opt.out_dir, name) for name in (CHAT_JSON, CHAT_INDEX)]
+    if any(os.path.exists(path) and os.path.getmtime(path) > os.path.getmtime(marker) for path in inputs):
+        return False
+    try:
+        with open(marker, 'r', encoding='utf-8') as f:
+            return json.load(f)['options'] == thumbnail_options(opt)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def _init_batch_worker(nworkers: int):
+    logger.setLevel('INFO')
+    # share the cores between the videos processed at the same time
+    share_cv_threads(nworkers)
+
+
+def _hecate_batch_item(args: list, video_file: str) -> dict:
+    opt = config.HecateParams(args + ['-f', video_file])
+    record = {'video': opt.video_file}
+    if not opt.force and thumbnails_up_to_date(opt):
+        record['status'] = 'skipped'
+        return record
+    if opt.profile:
+        # one profile per video, next to its thumbnails
+        opt.profile = os.path.join(opt.out_dir, os.path.basename(opt.profile))
+        record['profile'] = opt.profile
+
+    start = time.time()
+    timings = {}
+    try:
+        v_thumb_idx = hecate(opt, timings)
+    except Exception as e:
+        logger.error(f'Failed to process {video_file}: {e!r}')
+        record.update(status='failed', error=repr(e), seconds=time.time() - start, timings=timings)
+        return record
+    record.update(status='done', seconds=time.time() - start, timings=timings,
+                  frames=[int(i) for i in v_thumb_idx[:opt.njpg]])
+
+    with open(os.path.join(opt.out_dir, 'thumbnails', BATCH_MARKER), 'w', encoding='utf-8') as f:
+        json.dump({'options': thumbnail_options(opt), 'frames': record['frames']}, f)
+    return record
+
+
+def hecate_batch(opt: config.HecateParams, args: list):
+    """
+    Process every video below opt.batch_dir on opt.batch_workers processes, appending one JSON line per video to
+    opt.summary_file.
+    """
+    videos = discover_videos(opt.batch_dir)
+    logger.info(f'Found {len(videos)} videos in {opt.batch_dir}')
+    summary_file = opt.summary_file or os.path.join(opt.batch_dir, 'summary.jsonl')
+
+    counts = {}
+    with open(summary_file, 'a', encoding='utf-8') as summary, \
+            ProcessPoolExecutor(max_workers=opt.batch_workers, initializer=_init_batch_worker,
+                                initargs=(opt.batch_workers,)) as executor:
+        futures = [executor.submit(_hecate_batch_item, args, video) for video in videos]
+        for future in as_completed(futures):
+            record = future.result()
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+            summary.write(json.dumps(record, ensure_ascii=False) + '\n')
+            summary.flush()
+            logger.info(f'[{sum(counts.values())}/{len(videos)}] {record["status"]}: {record["video"]}')
+    logger.info(f'Batch finished: {counts}, summary in {summary_file}')
+    return counts
 
 
 if __name__ == '__main__':
     logger.setLevel('INFO')
     opt = config.HecateParams(sys.argv[1:])
-    hecate(opt)
+    if opt.batch_dir:
+        hecate_batch(opt, sys.argv[1:])
+    else:
+        hecate(opt)
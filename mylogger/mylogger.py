@@ -1,5 +1,9 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import types
 
 log_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'log.log')
 if not os.path.exists(os.path.dirname(log_file)):
@@ -24,41 +28,98 @@ logging.basicConfig(level=logging.DEBUG, format=log_format, datefmt=date_format)
 logger_instance = logging.getLogger(__name__)
 logger_instance.setLevel(logging.DEBUG)
 file_handler.setFormatter(formatter)
-logger_instance.addHandler(file_handler)
+
+# log.log is written by a background thread, callers only put records on a queue
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+logger_instance.addHandler(queue_handler)
+queue_listener = logging.handlers.QueueListener(log_queue, file_handler)
+queue_listener.start()
+
+
+def _stop_listener():
+    if queue_listener._thread is not None:
+        queue_listener.stop()
+
+
+def _restart_listener():
+    queue_listener.start()
+
+
+def _restart_listener_in_child():
+    # the listener is stopped around fork, so the child does not inherit the file mid-write
+    global log_queue, queue_listener
+    log_queue = queue.SimpleQueue()
+    queue_handler.queue = log_queue
+    queue_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    queue_listener.start()
+
+
+atexit.register(_stop_listener)
+os.register_at_fork(before=_stop_listener, after_in_parent=_restart_listener, after_in_child=_restart_listener_in_child)
+
+
+def _format(msg, args):
+    """
+    Join the arguments with spaces. With args, the single argument is a format string %-interpolated with them, as
+    in logging. A single function taking no arguments is called for the message.
+    """
+    if args is not None:
+        msg, = msg
+        return msg % tuple(args)
+    if len(msg) == 1 and isinstance(msg[0], types.FunctionType) and msg[0].__code__.co_argcount == 0:
+        msg = (msg[0](),)
+    return ' '.join([str(m) for m in msg])
 
 
 class MyLogger:
+    """
+    Arguments are only formatted when their level is enabled, so expensive ones can be passed lazily, e.g.
+    logger.debug('labels: %s', args=(km_lbl,)) or logger.debug(lambda: f'labels: {km_lbl}').
+    """
+
+    @classmethod
+    def isEnabledFor(cls, level):
+        return logger_instance.isEnabledFor(level)
+
     @classmethod
-    def debug(cls, *msg):
-        logger_instance.debug(' '.join([str(m) for m in msg]))
+    def debug(cls, *msg, args=None):
+        if logger_instance.isEnabledFor(logging.DEBUG):
+            logger_instance.debug(_format(msg, args))
 
     @classmethod
-    def info(cls, *msg):
-        logger_instance.info(' '.join([str(m) for m in msg]))
+    def info(cls, *msg, args=None):
+        if logger_instance.isEnabledFor(logging.INFO):
+            logger_instance.info(_format(msg, args))
 
     @classmethod
-    def warning(cls, *msg):
-        logger_instance.warning(' '.join([str(m) for m in msg]))
+    def warning(cls, *msg, args=None):
+        if logger_instance.isEnabledFor(logging.WARNING):
+            logger_instance.warning(_format(msg, args))
 
     warn = warning
 
     @classmethod
-    def error(cls, *msg):
-        logger_instance.error(' '.join([str(m) for m in msg]))
+    def error(cls, *msg, args=None):
+        if logger_instance.isEnabledFor(logging.ERROR):
+            logger_instance.error(_format(msg, args))
 
     @classmethod
-    def critical(cls, *msg):
-        logger_instance.critical(' '.join([str(m) for m in msg]))
+    def critical(cls, *msg, args=None):
+        if logger_instance.isEnabledFor(logging.CRITICAL):
+            logger_instance.critical(_format(msg, args))
 
     fatal = critical
 
     @classmethod
-    def exception(cls, *msg):
-        logger_instance.exception(' '.join([str(m) for m in msg]))
+    def exception(cls, *msg, args=None):
+        if logger_instance.isEnabledFor(logging.ERROR):
+            logger_instance.exception(_format(msg, args))
 
     @classmethod
-    def log(cls, level, *msg):
-        logger_instance.log(level, ' '.join([str(m) for m in msg]))
+    def log(cls, level, *msg, args=None):
+        if logger_instance.isEnabledFor(level):
+            logger_instance.log(level, _format(msg, args))
 
     @classmethod
     def setLevel(cls, level):
@@ -0,0 +1,193 @@
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+_profiler = None
+_disabled = nullcontext()
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Span:
+    def __init__(self, profiler, name, parent, tid):
+        self.profiler = profiler
+        self.name = name
+        self.parent = parent
+        self.tid = tid
+        self.counters = {}
+        self.start = self.end = 0.0
+        self.cpu = 0.0
+        self.rss_mb = 0.0
+        self.alloc_peak = 0
+        self._alloc_start = 0
+        self._alloc_peak_so_far = 0
+
+    def __enter__(self):
+        self.profiler._push(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._pop(self)
+        return False
+
+
+class Profiler:
+    """
+    Records nested spans per thread with wall time, CPU time of the thread, RSS at the end and, with memory=True,
+    the peak of traced Python allocations above the level at the start of the span.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.spans = []
+        self.counters = {}
+        self.origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name):
+        stack = self._stack()
+        return Span(self, name, stack[-1] if stack else None, threading.get_ident())
+
+    def _push(self, span):
+        stack = self._stack()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # keep what the enclosing span has seen so far, the peak is reset for this one
+                stack[-1]._alloc_peak_so_far = max(stack[-1]._alloc_peak_so_far, peak)
+            span._alloc_start = span._alloc_peak_so_far = current
+            tracemalloc.reset_peak()
+        stack.append(span)
+        span.cpu = time.thread_time()
+        span.start = time.perf_counter()
+
+    def _pop(self, span):
+        span.end = time.perf_counter()
+        span.cpu = time.thread_time() - span.cpu
+        span.rss_mb = _rss_mb()
+        stack = self._stack()
+        stack.pop()
+        if self.memory:
+            peak = max(span._alloc_peak_so_far, tracemalloc.get_traced_memory()[1])
+            span.alloc_peak = peak - span._alloc_start
+            if stack:
+                stack[-1]._alloc_peak_so_far = max(stack[-1]._alloc_peak_so_far, peak)
+            tracemalloc.reset_peak()
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name, n=1):
+        stack = self._stack()
+        if stack:
+            # spans are only touched by their own thread
+            stack[-1].counters[name] = stack[-1].counters.get(name, 0) + n
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """
+        Spans merged by their path of names into a tree of calls, wall and CPU seconds, peaks and counters.
+        """
+        nodes = {}
+        roots = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            path = []
+            s = span
+            while s is not None:
+                path.append(s.name)
+                s = s.parent
+            path = tuple(reversed(path))
+            node = nodes.get(path)
+            if node is None:
+                node = nodes[path] = {'name': span.name, 'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'rss_mb': 0.0,
+                                      'counters': {}, 'children': []}
+                if self.memory:
+                    node['alloc_peak_mb'] = 0.0
+                # spans still open when the summary is taken are missing, their children become roots
+                if path[:-1] in nodes:
+                    nodes[path[:-1]]['children'].append(node)
+                else:
+                    roots.append(node)
+            node['calls'] += 1
+            node['wall'] += span.end - span.start
+            node['cpu'] += span.cpu
+            node['rss_mb'] = max(node['rss_mb'], span.rss_mb)
+            if self.memory:
+                node['alloc_peak_mb'] = max(node['alloc_peak_mb'], span.alloc_peak / (1 << 20))
+            for key, value in span.counters.items():
+                node['counters'][key] = node['counters'].get(key, 0) + value
+        return {
+            'wall': time.perf_counter() - self.origin,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'counters': dict(self.counters),
+            'spans': roots,
+        }
+
+    def chrome_trace(self):
+        """
+        The spans as complete events of the Chrome trace event format (chrome://tracing, Perfetto).
+        """
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            args = {'cpu_ms': span.cpu * 1e3, 'rss_mb': span.rss_mb, **span.counters}
+            if self.memory:
+                args['alloc_peak_mb'] = span.alloc_peak / (1 << 20)
+            events.append({'name': span.name, 'ph': 'X', 'pid': pid, 'tid': span.tid,
+                           'ts': (span.start - self.origin) * 1e6, 'dur': (span.end - span.start) * 1e6,
+                           'args': args})
+        return {'traceEvents': sorted(events, key=lambda e: e['ts']), 'displayTimeUnit': 'ms',
+                'otherData': {'counters': dict(self.counters)}}
+
+    def write(self, path, format='json'):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace() if format == 'chrome' else self.summary(), f, indent=1)
+
+
+def enable(memory=False):
+    global _profiler
+    _profiler = Profiler(memory)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None and profiler.memory:
+        tracemalloc.stop()
+    return profiler
+
+
+def span(name):
+    """
+    Context manager timing the enclosed code as a span nested in the current one; a shared no-op when profiling
+    is disabled.
+    """
+    if _profiler is None:
+        return _disabled
+    return _profiler.span(name)
+
+
+def count(name, n=1):
+    if _profiler is not None:
+        _profiler.count(name, n)
@@ -0,0 +1,306 @@
+import base64
+import http.client
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2 as cv
+import numpy as np
+
+import config
+import thumnail_extraction
+from frames import share_cv_threads
+from mylogger import logger
+from video_parser import VideoParser
+
+
+def _init_service_worker(nworkers: int):
+    logger.setLevel('WARNING')
+    share_cv_threads(nworkers)
+
+
+def _warm_up():
+    # an empty job: it only makes the pool start its worker processes and run their imports and initializer,
+    # nothing is cached for later jobs
+    pass
+
+
+def _run_job(args: list, jpeg: bool, submitted: float) -> dict:
+    started = time.time()
+    opt = config.HecateParams(args)
+    parser = VideoParser()
+    v_shot_range = parser.parse_video(opt)
+    parsed = time.time()
+    v_thumb_idx = thumnail_extraction.detect_thumbnail_frames(
+        opt=opt, meta=parser.meta, v_shot_range=v_shot_range,
+        feature=parser.feature, diff=parser.X_diff, chat_scores=parser.chat_scores)
+    v_thumb_idx = [int(i) for i in v_thumb_idx[:opt.njpg]]
+    detected = time.time()
+
+    result = {'frames': v_thumb_idx}
+    if jpeg:
+        frames = thumnail_extraction.read_frames(opt.video_file, v_thumb_idx)
+        result['jpeg'] = [base64.b64encode(cv.imencode('.jpg', frames[i])[1].tobytes()).decode('ascii')
+                          if i in frames else None for i in v_thumb_idx]
+    result['timings'] = {
+        'queued': started - submitted,
+        'parse_video': parsed - started,
+        'detect_thumbnail_frames': detected - parsed,
+        'encode': time.time() - detected,
+    }
+    return result
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ThumbnailService:
+    """
+    Runs thumbnail jobs on a pool of warm worker processes. At most workers jobs run at once and at most
+    queue_size more wait for a worker; further jobs are rejected with QueueFull instead of piling up.
+    """
+
+    def __init__(self, workers=1, queue_size=8, history=1000):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_service_worker,
+                                            initargs=(self.workers,))
+        self.slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=history)
+        self.counts = {'done': 0, 'failed': 0, 'rejected': 0}
+        self.active = 0
+
+        # start every worker now, so the first jobs do not pay for process start-up and imports
+        for future in [self.executor.submit(_warm_up) for _ in range(self.workers)]:
+            future.result()
+        logger.info(f'Thumbnail service ready with {self.workers} workers')
+
+    def run(self, video_file: str, njpg: int = 8, options: list = (), jpeg: bool = False) -> dict:
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.counts['rejected'] += 1
+            raise QueueFull(f'{self.workers} jobs running and {self.queue_size} queued')
+        submitted = time.time()
+        with self.lock:
+            self.active += 1
+        try:
+            args = list(options) + ['-f', video_file, '-n', str(njpg)]
+            result = self.executor.submit(_run_job, args, jpeg, submitted).result()
+        except Exception:
+            with self.lock:
+                self.counts['failed'] += 1
+            raise
+        finally:
+            with self.lock:
+                self.active -= 1
+            self.slots.release()
+
+        result['timings']['total'] = time.time() - submitted
+        with self.lock:
+            self.counts['done'] += 1
+            self.latencies.append(result['timings']['total'])
+        return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            latencies = np.array(self.latencies)
+            stats = {'workers': self.workers, 'queue_size': self.queue_size, 'active': self.active, **self.counts}
+        if len(latencies) > 0:
+            stats['latency'] = {'p50': float(np.percentile(latencies, 50)), 'p95': float(np.percentile(latencies, 95)),
+                                'max': float(np.max(latencies))}
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class ThumbnailHandler(BaseHTTPRequestHandler):
+    """
+    POST /thumbnails with a JSON job {"video": path, "njpg": 8, "options": [...], "jpeg": false} returns
+    {"frames": [...], "timings": {...}} (and base64 JPEGs with "jpeg": true). GET /stats returns the service stats.
+    """
+
+    service: ThumbnailService = None
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, self.service.stats())
+        else:
+            self.reply(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/thumbnails':
+            self.reply(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            video_file = job['video']
+            njpg = int(job.get('njpg', 8))
+            options = [str(arg) for arg in job.get('options', [])]
+            jpeg = bool(job.get('jpeg', False))
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(400, {'error': f'bad job: {e!r}'})
+            return
+        if not os.path.exists(video_file):
+            self.reply(404, {'error': f'no such video: {video_file}'})
+            return
+
+        try:
+            result = self.service.run(video_file, njpg, options, jpeg)
+        except QueueFull as e:
+            self.reply(503, {'error': str(e)}, {'Retry-After': '1'})
+            return
+        except Exception as e:
+            logger.error(f'Job {video_file} failed: {e!r}')
+            self.reply(500, {'error': repr(e)})
+            return
+        logger.info(f'{video_file}: frames {result["frames"]}, {result["timings"]["total"]:.3f} seconds '
+                    f'({result["timings"]["queued"]:.3f} queued)')
+        self.reply(200, result)
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(lambda: f'{self.address_string()} {format % args}')
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class ThumbnailClient:
+    """
+    Minimal client for a running thumbnail server, over TCP (host, port) or a Unix socket (unix_path).
+    """
+
+    def __init__(self, host='127.0.0.1', port=8000, unix_path=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self.timeout = timeout
+
+    def _request(self, method, path, body=None):
+        if self.unix_path:
+            conn = UnixHTTPConnection(self.unix_path, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            data = None if body is None else json.dumps(body).encode('utf-8')
+            conn.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def thumbnails(self, video_file, njpg=8, options=(), jpeg=False):
+        """
+        Return (status, result); result['jpeg'] holds the decoded JPEG bytes when jpeg is True.
+        """
+        status, result = self._request('POST', '/thumbnails', {
+            'video': os.path.abspath(video_file), 'njpg': njpg, 'options': list(options), 'jpeg': jpeg})
+        if status == 200 and jpeg:
+            result['jpeg'] = [None if data is None else base64.b64decode(data) for data in result['jpeg']]
+        return status, result
+
+    def stats(self):
+        return self._request('GET', '/stats')[1]
+
+
+def parse_args(args):
+    parser = ArgumentParser(description='Serve thumbnail jobs over HTTP')
+    parser.add_argument('--host', type=str, action='store', dest='host', default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, action='store', dest='port', default=8000, help='Port to listen on')
+    parser.add_argument('--unix', type=str, action='store', dest='unix', default=None,
+                        help='Listen on this Unix socket instead of host:port')
+    parser.add_argument('--server_workers', type=int, action='store', dest='workers', default=2,
+                        help='Number of worker processes, i.e. jobs running at once')
+    parser.add_argument('--queue_size', type=int, action='store', dest='queue_size', default=8,
+                        help='Number of jobs waiting for a worker before new ones are rejected')
+    parser.add_argument('--request', type=str, action='store', dest='request', default=None,
+                        help='Send this video to a running server as a client and print the result')
+
+    return parser.parse_known_args(args)
+
+
+def serve(args):
+    opt, job_args = parse_args(args)
+    if opt.request is not None:
+        # stand-in client, other arguments are passed on as job options, -n goes in the job itself
+        client = ThumbnailClient(opt.host, opt.port, opt.unix)
+        njpg_parser = ArgumentParser(add_help=False)
+        njpg_parser.add_argument('-n', '--njpg', type=int, action='store', dest='njpg', default=8)
+        njpg_opt, options = njpg_parser.parse_known_args(job_args)
+        status, result = client.thumbnails(opt.request, njpg_opt.njpg, options)
+        print(status, json.dumps(result))
+        return
+
+    service = ThumbnailService(opt.workers, opt.queue_size)
+    ThumbnailHandler.service = service
+    if opt.unix:
+        server = UnixHTTPServer(opt.unix, ThumbnailHandler)
+        logger.info(f'Listening on {opt.unix}')
+    else:
+        server = ThreadingHTTPServer((opt.host, opt.port), ThumbnailHandler)
+        logger.info(f'Listening on http://{opt.host}:{server.server_port}')
+    server.daemon_threads = True
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if opt.unix and os.path.exists(opt.unix):
+            os.remove(opt.unix)
+
+
+if __name__ == '__main__':
+    logger.setLevel('INFO')
+    serve(sys.argv[1:])
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import func
+
+
+def duplicate_rows(seed=0):
+    # a static shot: most rows are one repeated feature, plus a few distinct ones
+    rng = np.random.default_rng(seed)
+    still = np.tile(rng.random((1, 16), dtype=np.float32), (40, 1))
+    return np.concatenate([still, rng.random((6, 16), dtype=np.float32), still])
+
+
+@pytest.mark.parametrize('method', sorted(func.KMEANS_METHODS))
+def test_no_empty_cluster_with_duplicate_rows(method):
+    km_data = duplicate_rows()
+    km_lbl, km_ctr = func.perform_kmeans(km_data, 8, method=method, batch_size=4, max_samples=3)
+    assert km_lbl.shape == (len(km_data), 1)
+    assert np.all(np.bincount(km_lbl[:, 0], minlength=8) > 0)
+    assert km_ctr.shape == (8, km_data.shape[1])
+
+
+def test_reseed_empty_clusters_moves_farthest_row():
+    km_data = np.array([[0.0], [0.0], [1.0], [5.0]], dtype=np.float32)
+    km_ctr = np.array([[0.0], [0.0], [3.0]], dtype=np.float32)
+    km_lbl = func.assign_clusters(km_data, km_ctr)
+    assert km_lbl[:, 0].tolist() == [0, 0, 0, 2]
+
+    # the row at 5 is farther from its center, but it is alone in its cluster
+    km_lbl, km_ctr = func.reseed_empty_clusters(km_data, km_lbl, km_ctr)
+    assert km_lbl[:, 0].tolist() == [0, 0, 1, 2]
+    assert km_ctr[1, 0] == 1.0
@@ -8,125 +8,112 @@ import numpy as np
 import func
 import config
 from mylogger import logger
+from video_parser import ShotTable
+
+
+def group_argmin(values: np.ndarray, groups: np.ndarray, ngroups: int) -> np.ndarray:
+    """
+    Index of the first minimum of values within each group, -1 for groups without any value below
+    sys.float_info.max (empty ones, or only NaN and infinite values).
+    """
+    v_idx = np.flatnonzero(values < sys.float_info.max)
+    v_idx = v_idx[np.lexsort((v_idx, values[v_idx], groups[v_idx]))]
+    first = np.ones(len(v_idx), dtype=bool)
+    first[1:] = groups[v_idx[1:]] != groups[v_idx[:-1]]
+    v_min_idx = -np.ones(ngroups, dtype=np.int64)
+    v_min_idx[groups[v_idx[first]]] = v_idx[first]
+    return v_min_idx
 
 
 @func.time_it
-def detect_thumbnail_frames(opt: config.HecateParams, meta: config.VideoMetadata, v_shot_range: list,
+def detect_thumbnail_frames(opt: config.HecateParams, meta: config.VideoMetadata, v_shot_range: ShotTable,
                             feature: np.ndarray, diff: np.ndarray, chat_scores: np.ndarray) -> list:
-    v_thumb_idx = []
-
     minK = 5
     maxK = 30
-    nfrm = meta.nframes
+    nfrm = min(meta.nframes, len(diff), len(chat_scores))
 
-    v_frm_valid = [False] * nfrm
-    for i in range(len(v_shot_range)):
-        for j in range(len(v_shot_range[i].v_idx)):
-            v_frm_valid[v_shot_range[i].v_idx[j]] = True
+    # keyframes and lengths of all sub-shots, ordered by shot
+    subshots = v_shot_range.subshots
+    v_valid_frm_idx = subshots['keyframe']
+    v_valid_frm_shotlen = subshots['end'] - subshots['start'] + 1
 
-    def score_func(index: int) -> float:
-        # return func.mat_at(diff, index)                                                 # stillness
-        # return (1.0 - chat_scores[index]) * opt.chat_alpha                              # chat
-        return func.mat_at(diff, index) + (1.0 - chat_scores[index]) * opt.chat_alpha   # stillness + chat
+    # stillness + chat, computed in float64 as for single frames
+    # v_score = diff[:nfrm, 0]                                                      # stillness
+    # v_score = (1.0 - chat_scores[:nfrm].astype(np.float64)) * opt.chat_alpha      # chat
+    v_score = diff[:nfrm, 0] + (1.0 - chat_scores[:nfrm].astype(np.float64)) * opt.chat_alpha
 
-    nfrm_valid = sum(v_frm_valid)
+    nfrm_valid = len(v_valid_frm_idx)
     if nfrm_valid == 0:
         # If there's no valid frame, pick one most still/chat frame
-        min_idx = -1
-        min_val = sys.float_info.max
-        for i in range(nfrm):
-            val = score_func(i)
-            if val < min_val:
-                min_val = val
-                min_idx = i
-        logger.debug(f'No valid frame, pick most still/chat frame: {min_idx}, value = {min_val}')
-        v_thumb_idx.append(min_idx)
-    elif nfrm_valid <= opt.njpg:
+        min_idx = int(group_argmin(v_score, np.zeros(nfrm, dtype=np.int64), 1)[0])
+        logger.debug('No valid frame, pick most still/chat frame: %d, value = %s',
+                     args=(min_idx, v_score[min_idx] if min_idx >= 0 else None))
+        return [min_idx]
+
+    if nfrm_valid <= opt.njpg:
         # If not enough frames are left,
         # include all remaining keyframes sorted by shot length
-        v_shot_len = []
-        v_keyfrm_idx = []
-        for i in range(len(v_shot_range)):
-            max_subshot_id = -1
-            max_subshot_len = -1
-            for j in range(len(v_shot_range[i].v_range)):
-                shotlen = v_shot_range[i].v_range[j].length()
-                if shotlen > max_subshot_len:
-                    max_subshot_id = j
-                    max_subshot_len = shotlen
-            v_shot_len.append(max_subshot_len)
-            v_keyfrm_idx.append(v_shot_range[i].v_range[max_subshot_id].v_idx[0])
-
-        # Include keyframes sorted by shot length
-        _, v_srt_idx = func.hecate_sort(v_shot_len)     # sorted indices/values
-        len_idx = len(v_srt_idx)
-        for i in range(len_idx):
-            v_thumb_idx.append(v_keyfrm_idx[v_srt_idx[len_idx - 1 - i]])
-    else:
-        v_valid_frm_idx = []
-        v_valid_frm_shotlen = []
-        for i in range(len(v_shot_range)):
-            for j in range(len(v_shot_range[i].v_range)):
-                v_valid_frm_idx.append(v_shot_range[i].v_range[j].v_idx[0])
-                v_valid_frm_shotlen.append(v_shot_range[i].v_range[j].length())
-        # logger.debug(f'v_valid_frm_idx: {len(v_valid_frm_idx)} {v_valid_frm_idx}')
-
-        km_data = np.zeros(shape=(nfrm_valid, feature.shape[1]), dtype=feature.dtype)
-        for i in range(len(v_valid_frm_idx)):
-            km_data[i] = feature[v_valid_frm_idx[i]].copy()
-
-        km_k = min(maxK, min(nfrm_valid, max(minK, opt.njpg)))
-        km_lbl, km_ctr = func.perform_kmeans(km_data, km_k, opt.njpg)
-
-        clust_sz = [0] * km_k
-        for i in range(km_lbl.shape[0]):
-            clust_sz[func.mat_at(km_lbl, i)] += v_valid_frm_shotlen[i]
-
-        _, v_srt_idx = func.hecate_sort(clust_sz)   # sorted indices/values
-
-        # obtain thumbnails -- the most still frame per cluster
-        for i in range(km_k):
-            min_idx = -1
-            min_val = sys.float_info.max
-            for j in range(km_lbl.shape[0]):
-                if func.mat_at(km_lbl, j) == v_srt_idx[km_k - 1 - i]:
-                    val = score_func(v_valid_frm_idx[j])
-                    if val < min_val:
-                        min_idx = j
-                        min_val = val
-            # logger.debug(f'v_valid_frm_idx[min_idx]')
-            # logger.debug(f'v_valid_frm_idx[{min_idx}]')
-            # logger.debug(f'{v_valid_frm_idx[min_idx]}')
-            v_thumb_idx.append(v_valid_frm_idx[min_idx])
-
-    return v_thumb_idx
+        # the longest sub-shot of each shot stands for it, the first one of equal length
+        v_first = np.searchsorted(subshots['parent'], np.arange(len(v_shot_range)))
+        v_last = np.append(v_first[1:], nfrm_valid) - 1
+        v_longest = func.segment_argmin(-v_valid_frm_shotlen, v_first, v_last)
+
+        # Include keyframes sorted by shot length, longest first and later shots first among equal ones
+        v_srt_idx = np.argsort(v_valid_frm_shotlen[v_longest], kind='stable')[::-1]
+        return v_valid_frm_idx[v_longest[v_srt_idx]].tolist()
+
+    km_data = feature[v_valid_frm_idx]
+
+    km_k = min(maxK, min(nfrm_valid, max(minK, opt.njpg)))
+    km_lbl, km_ctr = func.perform_kmeans(km_data, km_k, opt.njpg, method=opt.kmeans, batch_size=opt.kmeans_batch,
+                                         max_samples=opt.kmeans_samples)
+    km_lbl = km_lbl[:, 0]
+
+    clust_sz = np.bincount(km_lbl, weights=v_valid_frm_shotlen, minlength=km_k)
+    v_srt_idx = np.argsort(clust_sz, kind='stable')[::-1]   # largest first, later clusters first among equal ones
+
+    # obtain thumbnails -- the most still frame per cluster, clusters without a candidate get the last keyframe
+    v_min_idx = group_argmin(v_score[v_valid_frm_idx], km_lbl, km_k)
+    return v_valid_frm_idx[v_min_idx[v_srt_idx]].tolist()
+
+
+def thumbnail_ranks(v_thumb_idx: list, njpg: int) -> dict:
+    # frame index -> rank, the first rank wins when a frame is selected twice
+    v_rank = {}
+    for rank in range(min(len(v_thumb_idx), njpg)):
+        v_rank.setdefault(v_thumb_idx[rank], rank)
+    return v_rank
+
+
+def read_frames(video_file: str, v_idx) -> dict:
+    """
+    Decode the frames at the given indices in one pass up to the last of them, frames in between are only
+    grabbed, not converted.
+    """
+    v_idx = set(v_idx)
+    frames = {}
+    if len(v_idx) == 0:
+        return frames
+    video = cv2.VideoCapture(video_file)
+    assert video.isOpened(), 'Cannot capture source'
+    for frame_index in range(max(v_idx) + 1):
+        if not video.grab():
+            break
+        if frame_index in v_idx:
+            ret, frame = video.retrieve()
+            if ret:
+                frames[frame_index] = frame
+    video.release()
+    return frames
 
 
 @func.time_it
 def generate_thumbnails(opt: config.HecateParams, v_thumb_idx: list) -> None:
-    njpg_count = 0
-    frame_index = 0
-
     out_dir = os.path.join(opt.out_dir, 'thumbnails')
     if os.path.exists(out_dir):
         shutil.rmtree(out_dir)
     os.makedirs(out_dir)
 
-    video = cv2.VideoCapture(opt.video_file)
-    assert video.isOpened(), 'Cannot capture source'
-    while njpg_count < len(v_thumb_idx):
-        ret, frame = video.read()
-        if not ret:
-            break
-        rank = -1
-        for i in range(len(v_thumb_idx)):
-            if frame_index == v_thumb_idx[i]:
-                rank = i
-                break
-        if 0 <= rank < opt.njpg:
-            cv2.imwrite(os.path.join(out_dir, f'{rank}.jpg'), frame)
-            njpg_count += 1
-        if njpg_count >= opt.njpg:
-            break
-        frame_index += 1
-    video.release()
+    v_rank = thumbnail_ranks(v_thumb_idx, opt.njpg)
+    for frame_index, frame in read_frames(opt.video_file, v_rank).items():
+        cv2.imwrite(os.path.join(out_dir, f'{v_rank[frame_index]}.jpg'), frame)
@@ -1,21 +1,110 @@
+import bisect
+import enum
 import os.path
 
 import cv2 as cv
 import numpy as np
 from tqdm import tqdm
-import sys
-import json
+from collections import deque
 
 import config
+from chat_index import CHAT_INDEX, CHAT_JSON, load_chat_times
+from feature_cache import FeatureCache
 import func
+from frames import DerivedStats, FrameData, FramePool, FrameStore, prefetch
 from mylogger import logger
+import profiler
+
+
+class ShotTable:
+    """
+    Shots and their sub-shots as rows of one structured array: first and last frame, keyframe (-1 for shots)
+    and the index of the parent shot (-1 for shots). Shots come first, sub-shots follow in order of their
+    first frame. Indexing and iterating give ShotRange views of the shots.
+    """
+
+    DTYPE = np.dtype([('start', '<i8'), ('end', '<i8'), ('keyframe', '<i8'), ('parent', '<i8')])
+
+    def __init__(self, rows=None):
+        self.rows = np.zeros(0, dtype=self.DTYPE) if rows is None else rows
+        self.nshots = int(np.count_nonzero(self.rows['parent'] < 0))
+
+    @classmethod
+    def from_shots(cls, starts, ends):
+        rows = np.zeros(len(starts), dtype=cls.DTYPE)
+        rows['start'] = starts
+        rows['end'] = ends
+        rows['keyframe'] = rows['parent'] = -1
+        return cls(rows)
+
+    def add_subshots(self, starts, ends, keyframes, parents):
+        sub = np.zeros(len(starts), dtype=self.DTYPE)
+        sub['start'] = starts
+        sub['end'] = ends
+        sub['keyframe'] = keyframes
+        sub['parent'] = parents
+        self.rows = np.concatenate([self.rows, sub])
+
+    @property
+    def shots(self):
+        return self.rows[:self.nshots]
+
+    @property
+    def subshots(self):
+        return self.rows[self.nshots:]
+
+    def subshot_slice(self, i):
+        # sub-shots are ordered by first frame, so those of shot i are contiguous and sorted by parent
+        first, last = np.searchsorted(self.subshots['parent'], [i, i + 1])
+        return slice(int(first), int(last))
+
+    def save(self, path):
+        np.save(path, self.rows, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        return cls(np.load(path, mmap_mode=mmap_mode, allow_pickle=False))
+
+    def __len__(self):
+        return self.nshots
+
+    def __getitem__(self, i):
+        if not -self.nshots <= i < self.nshots:
+            raise IndexError(f'shot {i} out of range')
+        return ShotRange(self, i % self.nshots)
+
+    def __iter__(self):
+        return (ShotRange(self, i) for i in range(self.nshots))
+
+    def __str__(self):
+        return str(list(self))
+
+    def __repr__(self):
+        return self.__str__()
 
 
 class Range:
-    def __init__(self, start, end):
-        self.start = start
-        self.end = end
-        self.v_idx = []
+    """
+    View of one row of a ShotTable.
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table: ShotTable, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def start(self):
+        return int(self.table.rows['start'][self.row])
+
+    @property
+    def end(self):
+        return int(self.table.rows['end'][self.row])
+
+    @property
+    def v_idx(self):
+        keyframe = int(self.table.rows['keyframe'][self.row])
+        return [keyframe] if keyframe >= 0 else []
 
     def length(self):
         return len(self)
@@ -37,9 +126,19 @@ class Range:
 
 
 class ShotRange(Range):
-    def __init__(self, start, end):
-        super().__init__(start, end)
-        self.v_range = []
+    """
+    View of a shot of a ShotTable, its keyframes are those of its sub-shots.
+    """
+    __slots__ = ()
+
+    @property
+    def v_range(self):
+        rows = self.table.subshot_slice(self.row)
+        return [Range(self.table, self.table.nshots + row) for row in range(rows.start, rows.stop)]
+
+    @property
+    def v_idx(self):
+        return self.table.subshots['keyframe'][self.table.subshot_slice(self.row)].tolist()
 
     def __str__(self):
         text_list = ['ShotRange ', self._to_string()]
@@ -52,14 +151,99 @@ class ShotRange(Range):
         return self.__str__()
 
 
+class Reject(enum.IntFlag):
+    """
+    Reasons a frame was filtered out, several may apply.
+    """
+    DARK = 1
+    BLUR = 2
+    UNIFORM = 4
+    CUT = 8
+    ECR = 16
+    GFL = 32
+    REDUNDANT = 64
+    SHORT = 128
+
+
+_REJECT_LABELS = {Reject.GFL: '[GFL]', Reject.REDUNDANT: '[Redundant]'}
+
+
+class FrameTable:
+    """
+    Quality stats, validity and reject reasons (Reject bits) of every frame, one NumPy array per column.
+    """
+
+    def __init__(self, stats, valid=None, reasons=None):
+        stats = np.asarray(stats, dtype=np.float64).reshape(-1, 3)
+        self.brightness = np.ascontiguousarray(stats[:, 0])
+        self.sharpness = np.ascontiguousarray(stats[:, 1])
+        self.uniformity = np.ascontiguousarray(stats[:, 2])
+        self.valid = np.ones(len(stats), dtype=bool) if valid is None else np.array(valid, dtype=bool)
+        self.reasons = np.zeros(len(stats), dtype=np.uint16) if reasons is None else np.array(reasons, dtype=np.uint16)
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, idx):
+        return FrameInfo(self, idx)
+
+    def __iter__(self):
+        return (FrameInfo(self, i) for i in range(len(self)))
+
+    @property
+    def stats(self):
+        return np.stack([self.brightness, self.sharpness, self.uniformity], axis=1)
+
+    def take(self, v_idx):
+        """
+        Table of the frames at v_idx, which may repeat.
+        """
+        return FrameTable(self.stats[v_idx], self.valid[v_idx], self.reasons[v_idx])
+
+    def reject(self, idx, reason: Reject):
+        """
+        Mark the frames selected by idx (indices or a boolean mask) invalid for reason.
+        """
+        self.valid[idx] = False
+        self.reasons[idx] |= np.uint16(reason)
+
+    def flag(self, idx):
+        """
+        The reject reasons of frame idx as text, e.g. 'DARK BLUR '.
+        """
+        reasons = int(self.reasons[idx])
+        return ''.join(_REJECT_LABELS.get(r, r.name) + ' ' for r in Reject if reasons & r)
+
+
 class FrameInfo:
-    def __init__(self, id, brightness, sharpness, uniformity):
+    """
+    View of one frame of a FrameTable.
+    """
+    __slots__ = ('table', 'id')
+
+    def __init__(self, table: FrameTable, id):
+        self.table = table
         self.id = id
-        self.brightness = brightness
-        self.sharpness = sharpness
-        self.uniformity = uniformity
-        self.valid = True
-        self.flag = ""
+
+    @property
+    def brightness(self):
+        return self.table.brightness[self.id]
+
+    @property
+    def sharpness(self):
+        return self.table.sharpness[self.id]
+
+    @property
+    def uniformity(self):
+        return self.table.uniformity[self.id]
+
+    @property
+    def valid(self):
+        return bool(self.table.valid[self.id])
+
+    @property
+    def flag(self):
+        return self.table.flag(self.id)
 
     def __str__(self):
         return self.__repr__()
@@ -68,6 +252,21 @@ class FrameInfo:
         return f"[{self.id}][{self.valid}] B: {self.brightness}, S: {self.sharpness}, U:{self.uniformity}, F: {self.flag}"
 
 
+def smallest(values, k):
+    """
+    Mask of the k smallest values, ties broken towards lower indices as a stable sort would.
+    """
+    values = np.asarray(values)
+    mask = np.zeros(len(values), dtype=bool)
+    k = min(k, len(values))
+    if k <= 0:
+        return mask
+    kth = values[np.argpartition(values, k - 1)[k - 1]]
+    mask = values < kth
+    mask[np.flatnonzero(values == kth)[:k - np.count_nonzero(mask)]] = True
+    return mask
+
+
 def to_gray(bgr):
     gray = cv.cvtColor(bgr, cv.COLOR_BGR2GRAY)
     gray = cv.GaussianBlur(gray, (3, 3), 0)
@@ -97,9 +296,55 @@ def calc_uniformity(gray, num_bins=256):
     return (sum(sorted[:idx, :]) / sum(sorted)).item()
 
 
+def count_edges(bits, width):
+    # per-column number of edge pixels of bit-packed maps, batch axes are kept
+    return np.unpackbits(bits, axis=-1, count=width).sum(axis=-2, dtype=np.int32)
+
+
+def calc_dilation_element(scale):
+    # cross of radius 5 at native resolution, shrunk with the analysed frames
+    dl_sz = max(1, int(round(5 * scale)))
+    return cv.getStructuringElement(cv.MORPH_CROSS, (2 * dl_sz + 1, 2 * dl_sz + 1), (dl_sz, dl_sz))
+
+
+def calc_edge_maps(gray, dl_elm):
+    """
+    Canny edges and their dilation as boolean maps bit-packed along the rows (8 pixels per byte),
+    together with their per-column edge counts.
+    """
+    theta = cv.threshold(gray, 0, 255, cv.THRESH_BINARY | cv.THRESH_OTSU)[0]
+    edge = cv.Canny(gray, theta, 1.2 * theta)
+    edge_dl = cv.dilate(edge, dl_elm)
+    cnt = cv.reduce(edge, 0, cv.REDUCE_SUM, dtype=cv.CV_32S)[0] // 255
+    cnt_dl = cv.reduce(edge_dl, 0, cv.REDUCE_SUM, dtype=cv.CV_32S)[0] // 255
+    return np.packbits(edge, axis=-1), np.packbits(edge_dl, axis=-1), cnt, cnt_dl
+
+
+def calc_ecr(prev, cur, height):
+    """
+    Edge change ratio between frame pairs given the outputs of calc_edge_maps, which may carry a leading batch axis.
+    The sums reproduce the former uint8 edge images (1 on edges, 2 elsewhere) whose column sums wrapped at 256,
+    so X_ecr and the transition flags are unchanged.
+    """
+    prev_edge, prev_edge_dl, prev_cnt, prev_cnt_dl = prev
+    edge, edge_dl, cnt, cnt_dl = cur
+    width = cnt.shape[-1]
+    n_out = count_edges(prev_edge & edge_dl, width)
+    n_in = count_edges(prev_edge_dl & edge, width)
+    sum_out = np.mod(4 * height - 2 * prev_cnt - 2 * cnt_dl + n_out, 256).sum(axis=-1)
+    sum_in = np.mod(4 * height - 2 * prev_cnt_dl - 2 * cnt + n_in, 256).sum(axis=-1)
+    sum_prev = np.mod(2 * height - prev_cnt, 256).sum(axis=-1)
+    rho_out = 1 - np.minimum(1, sum_out) / np.maximum(1e-6, sum_prev)
+    rho_in = 1 - np.minimum(1, sum_in) / np.maximum(1e-6, sum_prev)
+    return np.maximum(rho_out, rho_in)
+
+
 def calc_hsv_hist(img, nbins=128):
-    cvt = cv.cvtColor(img, cv.COLOR_BGR2HSV)
-    planes = cv.split(cvt)
+    return calc_hsv_hist_h(cv.cvtColor(img, cv.COLOR_BGR2HSV), nbins)
+
+
+def calc_hsv_hist_h(hsv, nbins=128):
+    planes = cv.split(hsv)
 
     hist0 = cv.calcHist(planes[0:1], [0], None, [nbins], [0, 256])
     hist1 = cv.calcHist(planes[1:2], [0], None, [nbins], [0, 256])
@@ -155,7 +400,41 @@ def calc_egde_hist(gray, nbins_ori=16, nbins_mag=16):
 
 
 def calc_pyr_color_hist(img, nbins=128, level=2):
-    h, w, _ = img.shape
+    return calc_pyr_color_hist_h(cv.cvtColor(img, cv.COLOR_BGR2HSV), nbins, level)
+
+
+def pyr_cuts(size, level):
+    # boundaries of the patches of every pyramid level along one axis
+    return sorted({x * (size // 2 ** l) for l in range(level) for x in range(2 ** l + 1)})
+
+
+def calc_pyr_cell_hists(shape, level, calc_cell_hist):
+    """
+    Yield the raw histogram of every spatial-pyramid patch, in the order of the calc_pyr_*_hist layouts.
+    calc_cell_hist(y0, y1, x0, x1) is called once per cell of the grid cut by all patch boundaries, so each
+    pixel is binned once; patches of every level are then summed from the cells they cover.
+    """
+    h, w = shape[:2]
+    cuts_x = pyr_cuts(w, level)
+    cuts_y = pyr_cuts(h, level)
+    cells = np.array([[calc_cell_hist(y0, y1, x0, x1) for x0, x1 in zip(cuts_x[:-1], cuts_x[1:])]
+                      for y0, y1 in zip(cuts_y[:-1], cuts_y[1:])], dtype=np.float64)
+    integral = np.zeros([len(cuts_y), len(cuts_x), *cells.shape[2:]], dtype=np.float64)
+    integral[1:, 1:] = cells.cumsum(axis=0).cumsum(axis=1)
+
+    for l in range(level):
+        p_width = w // 2 ** l
+        p_height = h // 2 ** l
+        for x in range(2 ** l):
+            for y in range(2 ** l):
+                cx0 = cuts_x.index(x * p_width)
+                cx1 = cuts_x.index(x * p_width + p_width)
+                cy0 = cuts_y.index(y * p_height)
+                cy1 = cuts_y.index(y * p_height + p_height)
+                yield integral[cy1, cx1] - integral[cy0, cx1] - integral[cy1, cx0] + integral[cy0, cx0]
+
+
+def calc_pyr_color_hist_h(hsv, nbins=128, level=2):
     npatches = 0
     for i in range(level):
         npatches += 4 ** i
@@ -164,18 +443,16 @@ def calc_pyr_color_hist(img, nbins=128, level=2):
 
     hist = np.ndarray([hist_sz * npatches, 1], np.float32)
 
-    patch = 0
-    for l in range(level):
-        for x in range(2 ** l):
-            for y in range(2 ** l):
-                p_width = int(np.floor(w / 2 ** l))
-                p_height = int(np.floor(h / 2 ** l))
-                p_x = x * p_width
-                p_y = y * p_height
-                patch_img = img[p_y:p_y + p_height, p_x:p_x + p_width]
-                patch_hist = calc_hsv_hist(patch_img, nbins)
-                hist[hist_sz * patch:hist_sz * patch + hist_sz] = patch_hist
-                patch += 1
+    def calc_cell_hist(y0, y1, x0, x1):
+        cell = hsv[y0:y1, x0:x1]
+        return np.concatenate([cv.calcHist([cell], [c], None, [nbins], [0, 256]) for c in range(3)])
+
+    for patch, patch_hist in enumerate(calc_pyr_cell_hists(hsv.shape, level, calc_cell_hist)):
+        patch_hist = patch_hist.astype(np.float32)
+        for c in range(3):
+            channel_hist = patch_hist[c * nbins:(c + 1) * nbins]
+            cv.normalize(channel_hist, channel_hist)
+        hist[hist_sz * patch:hist_sz * patch + hist_sz] = patch_hist
 
     return hist
 
@@ -207,7 +484,13 @@ def calc_pyr_edge_hist(img, nbins_ori=16, nbins_mag=16, level=2):
 
 
 def calc_pyr_edge_hist_g(gx, gy, nbins_ori=16, nbins_mag=16, level=2):
-    h, w, _ = gx.shape
+    """
+    Edge pyramid histogram from the Scharr gradients of the whole frame. Orientation and magnitude are computed
+    once and every pixel is binned once; unlike calc_pyr_edge_hist, gradients at patch borders see the pixels
+    of the neighbour patch instead of a reflected border. The histograms are not the same as those of
+    calc_pyr_edge_hist: bins differ by up to about 0.01 at level 2 on 640x360 frames and 0.05-0.11 at levels 3-4,
+    more on smaller frames, since the patch borders then hold a larger share of the pixels.
+    """
     npatches = 0
     for i in range(level):
         npatches += 4 ** i
@@ -216,40 +499,72 @@ def calc_pyr_edge_hist_g(gx, gy, nbins_ori=16, nbins_mag=16, level=2):
 
     hist = np.ndarray([hist_sz * npatches, 1], dtype=np.float32)
 
-    patch = 0
-    for l in range(level):
-        for x in range(2 ** l):
-            for y in range(2 ** l):
-                p_width = int(np.floor(w / 2 ** l))
-                p_height = int(np.floor(h / 2 ** l))
-                p_x = x * p_width
-                p_y = y * p_height
-                patch_gx = gx[p_y:p_y + p_height, p_x:p_x + p_width]
-                patch_gy = gy[p_y:p_y + p_height, p_x:p_x + p_width]
-                patch_hist = calc_egde_hist_g(patch_gx, patch_gy, nbins_ori, nbins_mag)
-                hist[hist_sz * patch:hist_sz * patch + hist_sz] = patch_hist
-                patch += 1
+    ori = orientation(gx, gy)
+    mag = cv.magnitude(gx, gy)
+
+    def calc_cell_hist(y0, y1, x0, x1):
+        hist_ori = cv.calcHist([ori[y0:y1, x0:x1]], [0], None, [nbins_ori], [0, 180])
+        hist_mag = cv.calcHist([mag[y0:y1, x0:x1]], [0], None, [nbins_mag], [0, 256])
+        return np.concatenate([hist_ori, hist_mag])
+
+    for patch, patch_hist in enumerate(calc_pyr_cell_hists(gx.shape, level, calc_cell_hist)):
+        patch_hist = patch_hist.astype(np.float32)
+        hist_ori = patch_hist[:nbins_ori]
+        hist_mag = patch_hist[nbins_ori:]
+        cv.normalize(hist_ori, hist_ori)
+        cv.normalize(hist_mag, hist_mag)
+        hist[hist_sz * patch:hist_sz * patch + hist_sz] = patch_hist
 
     return hist
 
 
+def calc_frame_stats(data: FrameData):
+    gray = data.blurred()
+    return calc_brightness(data.bgr), calc_sharpness(gray), calc_uniformity(gray)
+
+
+def calc_histo_features(data: FrameData, pyr_level=2, nbins_color=128, nbins_edge_ori=8, nbins_edge_mag=8,
+                        frame_gradients=True):
+    color_hist = calc_pyr_color_hist_h(data.hsv(), nbins_color, pyr_level)
+    if frame_gradients:
+        gx, gy = data.gradients()
+        edge_hist = calc_pyr_edge_hist_g(gx, gy, nbins_edge_ori, nbins_edge_mag, pyr_level)
+    else:
+        edge_hist = calc_pyr_edge_hist(data.blurred(), nbins_edge_ori, nbins_edge_mag, pyr_level)
+    return np.concatenate([color_hist, edge_hist])[:, 0]
+
+
+def calc_list_frame(data: FrameData, dl_elm):
+    # everything parse_frame_info and filter_transition need from a single frame, the pairwise diff/ECR excepted
+    return calc_frame_stats(data), calc_edge_maps(data.blurred(), dl_elm)
+
+
+def calc_stream_frame(data: FrameData, dl_elm, *args):
+    # everything parse_stream needs from a single frame, the pairwise diff/ECR excepted
+    return calc_frame_stats(data), calc_histo_features(data, *args), calc_edge_maps(data.blurred(), dl_elm)
+
+
 def sbd_heuristic(v_diff, njumps, min_shot_len):
+    """
+    Greedily pick up to njumps frames of the largest diff as shot boundaries, each at least min_shot_len frames
+    from both ends of v_diff (1-D) and from every boundary picked before. Ties go to the later frame.
+    """
+    v_diff = np.asarray(v_diff).ravel()
+    nframes = len(v_diff)
     jump = []
-    sorted_v_idx = [i for i in range(len(v_diff))]
-    sorted_v_idx = sorted(sorted_v_idx, key=lambda id: v_diff[id])
-    sorted_v_diff = sorted(v_diff)
-    for i in range(len(sorted_v_diff) - 1, -1, -1):
-        add = True
-        if sorted_v_idx[i] + 1 < min_shot_len or len(v_diff) - sorted_v_idx[i] < min_shot_len:
-            add = False
-        else:
-            for j in range(len(jump)):
-                length = abs(jump[j] - sorted_v_idx[i]) + 1
-                if length < min_shot_len:
-                    add = False
-                    break
+    picked = []     # jump, sorted
+    for idx in np.argsort(v_diff, kind='stable')[::-1].tolist():
+        add = min_shot_len <= idx + 1 and nframes - idx >= min_shot_len
         if add:
-            jump.append(sorted_v_idx[i])
+            # only the closest picked boundaries on either side can be too close
+            pos = bisect.bisect_left(picked, idx)
+            if pos < len(picked) and picked[pos] - idx + 1 < min_shot_len:
+                add = False
+            elif pos > 0 and idx - picked[pos - 1] + 1 < min_shot_len:
+                add = False
+        if add:
+            jump.append(idx)
+            picked.insert(pos, idx)
         if len(jump) == njumps:
             break
     return jump
@@ -260,33 +575,123 @@ class VideoParser:
         self.chat_scores = None
         self.opt = None
         self.frame_list = None
-        self.info_list = None
+        self.frame_table = None
         self.ranges = None
         self.feature = None
         self.X_ecr = None
         self.X_diff = None
         self.meta = None
+        self.scale = 1.0
+        self.stride = 1
+        self.nframes_analysed = 0
+        self.frame_data = None
+        self.edge_maps = None
+        self.derived_stats = DerivedStats()
+        self.pool = FramePool(stats=self.derived_stats)
 
     @func.time_it
     def parse_video(self, opt: config.HecateParams):
         self.opt = opt
-        self.init(opt.video_file)
-        # frame_len = len(self.frame_list)
-        # if frame_len > 20000:
-        #     logger.warning("More than 20000 frames, only first 20000 frames will be kept.")
-        #     self.frame_list = self.frame_list[0:20000]
-        self.parse_frame_info()
-        self.filter_low_quality()
-        self.filter_transition()
-        self.extract_histo_features()
+        cache = key = None
+        if opt.cache_dir:
+            cache = FeatureCache(opt.cache_dir, opt.cache_size << 20)
+            key = self.cache_key(cache)
+            cached = cache.load(key)
+            if cached is not None:
+                logger.info(f'Loaded analysis results from cache entry {key}')
+                self.restore(*cached)
+                return self.ranges
+
+        if opt.workers > 1:
+            self.pool = FramePool(opt.workers, stats=self.derived_stats)
+        else:
+            self.pool = FramePool(opt.threads, stats=self.derived_stats, threads=True)
+        try:
+            self.analyse()
+        finally:
+            self.pool.shutdown()
+        self.expand_stride()
         self.post_process()
         self.update_shot_range(40)
         self.filter_redundant_and_obtain_subshots()
+        logger.info(f'Derived frame images: {self.derived_stats}')
+        if cache is not None:
+            cache.store(key, *self.snapshot())
 
         return self.ranges
 
-    @func.time_it
-    def init(self, path):
+    def cache_key(self, cache: FeatureCache):
+        """
+        Key of the video and chat contents and of every option the analysis depends on.
+        """
+        opt = self.opt
+        video_dir = os.path.dirname(opt.video_file)
+        files = [opt.video_file, os.path.join(video_dir, CHAT_JSON), os.path.join(video_dir, CHAT_INDEX)]
+        params = {
+            'invalid_wnd': opt.invalid_wnd,
+            'analysis_width': opt.analysis_width,
+            'stride': opt.stride,
+            'analysis_fps': opt.analysis_fps,
+            'chat_window': list(opt.chat_window),
+            'kmeans': [opt.kmeans, opt.kmeans_batch, opt.kmeans_samples],
+        }
+        return cache.key(files, params)
+
+    def snapshot(self):
+        """
+        The results of parse_video as (arrays, info) for FeatureCache.store.
+        """
+        arrays = {
+            'stats': self.frame_table.stats,
+            'valid': self.frame_table.valid,
+            'reasons': self.frame_table.reasons,
+            'X_diff': self.X_diff,
+            'X_ecr': self.X_ecr,
+            'feature': self.feature,
+            'chat_scores': self.chat_scores,
+            'shots': self.ranges.rows,
+        }
+        info = {
+            'meta': {'width': self.meta.width, 'height': self.meta.height, 'fps': self.meta.fps,
+                     'nframes': self.meta.nframes},
+            'scale': self.scale,
+            'stride': self.stride,
+            'nframes_analysed': self.nframes_analysed,
+        }
+        return arrays, info
+
+    def restore(self, arrays, info):
+        self.meta = config.VideoMetadata(**info['meta'])
+        self.scale = info['scale']
+        self.stride = info['stride']
+        self.nframes_analysed = info['nframes_analysed']
+
+        self.frame_table = FrameTable(arrays['stats'], arrays['valid'], arrays['reasons'])
+        self.X_diff = arrays['X_diff']
+        self.X_ecr = arrays['X_ecr']
+        self.feature = arrays['feature']
+        self.chat_scores = arrays['chat_scores']
+        self.ranges = ShotTable(arrays['shots'])
+
+    def analyse(self):
+        opt = self.opt
+        if opt.stream:
+            self.parse_stream()
+            self.filter_low_quality()
+            self.flag_transition()
+            self.omit_filtered_features()
+        else:
+            self.init(opt.video_file)
+            # frame_len = len(self.frame_list)
+            # if frame_len > 20000:
+            #     logger.warning("More than 20000 frames, only first 20000 frames will be kept.")
+            #     self.frame_list = self.frame_list[0:20000]
+            self.parse_frame_info()
+            self.filter_low_quality()
+            self.filter_transition()
+            self.extract_histo_features()
+
+    def open_video(self, path):
         video = cv.VideoCapture(path)
         assert video.isOpened(), 'Cannot capture source'
 
@@ -305,250 +710,338 @@ class VideoParser:
         self.meta = config.VideoMetadata(width=width, height=height, fps=fps, nframes=nframes)
         logger.info(f'Video metadata: {self.meta}')
 
-        self.frame_list = []
+        # analysis runs on frames downscaled to opt.analysis_width, never upscaled
+        self.scale = 1.0
+        if self.opt is not None and 0 < self.opt.analysis_width < width:
+            self.scale = self.opt.analysis_width / width
+            logger.info(f'Analysis resolution: {int(round(width * self.scale))}x{int(round(height * self.scale))}')
+
+        # only every stride-th frame is decoded and analysed, the others are grabbed and skipped
+        self.stride = 1
+        if self.opt is not None:
+            if self.opt.analysis_fps > 0:
+                self.stride = max(1, int(round(fps / self.opt.analysis_fps)))
+            else:
+                self.stride = max(1, self.opt.stride)
+        self.nframes_analysed = (nframes + self.stride - 1) // self.stride
+        if self.stride > 1:
+            logger.info(f'Analysing every {self.stride} frames, {self.nframes_analysed} frames in total')
+        return video
+
+    def downscale(self, frame):
+        if self.scale >= 1.0:
+            return frame
+        return cv.resize(frame, (int(round(frame.shape[1] * self.scale)), int(round(frame.shape[0] * self.scale))),
+                         interpolation=cv.INTER_AREA)
+
+    def decode_frames(self, video):
+        """
+        Yield a FrameData for every analysed frame of an opened video, downscaled for analysis.
+        Frames between two analysed ones are grabbed without being decoded.
+        """
+        idx = 0
         while True:
-            ret, frame = video.read()
-            if not ret:
+            if idx % self.stride == 0:
+                ret, frame = video.read()
+                if not ret:
+                    break
+                profiler.count('frames_decoded')
+                yield FrameData(self.downscale(frame), self.derived_stats)
+            elif not video.grab():
                 break
-            self.frame_list.append(frame)
+            idx += 1
+
+    @func.time_it
+    def init(self, path):
+        video = self.open_video(path)
+        max_ram_bytes = self.opt.max_frame_ram << 20 if self.opt is not None else 0
+        frame_list = []
+        for data in self.decode_frames(video):
+            if len(frame_list) == 0:
+                frame_list = FrameStore(data.bgr.shape, self.nframes_analysed, max_ram_bytes)
+            frame_list.append(data.bgr)
+        video.release()
+        if isinstance(frame_list, FrameStore) and frame_list.spilled:
+            logger.info(f'Frames spilled to disk: {len(frame_list)} x {frame_list.shape}')
+        self.frame_list = frame_list
+        self.frame_data = [FrameData(frame, self.derived_stats) for frame in frame_list]
+
+    @func.time_it
+    def parse_stream(self, window=2, queue_size=64, pyr_level=2, nbins_color=128, nbins_edge_ori=8, nbins_edge_mag=8):
+        """
+        Single-pass replacement for init + parse_frame_info + filter_transition + extract_histo_features.
+        Frames are analysed as they are decoded and only the last `window` frames are kept, plus the frames
+        queued between decoding and analysis, so peak memory does not grow with the video length. Features are
+        extracted for every frame; rows of filtered frames are cleared afterwards by omit_filtered_features.
+        """
+        assert window >= 2, 'Frame difference and ECR need at least 2 frames in the window'
+        video = self.open_video(self.opt.video_file)
+        nframes = self.nframes_analysed
+
+        dl_elm = calc_dilation_element(self.scale)
+
+        npatches = 0
+        for i in range(pyr_level):
+            npatches += 4 ** i
+        color_sz = npatches * 3 * nbins_color
+        self.feature = np.zeros([nframes, color_sz + npatches * (nbins_edge_ori + nbins_edge_mag)], dtype=np.float32)
+
+        stats_list = np.zeros([nframes, 3], dtype=np.float64)
+        v_dist = []
+        v_ecr = []
+        first_edges = None
+        img_size = 0
+        height = 0
+        recent = deque(maxlen=window)   # (FrameData, edge maps) of the latest frames
+        frames = self.decode_frames(video)
+        if self.opt.threads > 0:
+            # decode in a background thread, ahead of the analysis by at most queue_size frames
+            frames = prefetch(frames, queue_size)
+        frames = self.pool.map(frames, calc_stream_frame, (dl_elm, pyr_level, nbins_color, nbins_edge_ori, nbins_edge_mag))
+        for idx, (data, (stats, feature, edges)) in enumerate(tqdm(frames, total=nframes, desc="Parse frame stream")):
+            bgr = data.bgr
+            stats_list[idx] = stats
+            self.feature[idx] = feature
+
+            if len(recent) == 0:
+                height = bgr.shape[0]
+                img_size = bgr.shape[0] * bgr.shape[1]
+                first_edges = edges
+                v_dist.append(0)
+                v_ecr.append(0)
+            else:
+                prev_data, prev_edges = recent[-1]
+                v_dist.append(cv.norm(bgr - prev_data.bgr))
+                v_ecr.append(calc_ecr(prev_edges, edges, height))
+
+            if len(recent) == window:
+                recent[0][0].release()
+            recent.append((data, edges))
         video.release()
+        assert idx + 1 == nframes
+        self.frame_table = FrameTable(stats_list)
+        profiler.count('features', nframes)
+
+        # the first frame is compared against the last one, as in filter_transition
+        v_ecr[0] = calc_ecr(recent[-1][1], first_edges, height)
+        for data, _ in recent:
+            data.release()
+        recent.clear()
+
+        v_diff = [0]
+        for i in range(1, nframes - 1):
+            v_diff.append((v_dist[i] + v_dist[i + 1]) / (2. * img_size))
+        v_diff.append(0)
+        # the L2 difference per pixel grows as 1 / scale, bring it back to native-resolution units
+        self.X_diff = np.array(v_diff).reshape([len(v_diff), 1]) * self.scale
+        self.X_ecr = np.array(v_ecr).reshape([len(v_ecr), 1])
+
+        self.parse_chat_scores()
+        logger.info(f"Feature shape: {self.feature.shape}")
+        return self.frame_table
+
+    def expand_stride(self):
+        """
+        Hold the results of every analysed frame over the frames skipped after it, so that frame indices,
+        shot lengths and the chat window downstream are all in original-frame units.
+        """
+        if self.stride == 1:
+            return
+        hold = np.minimum(np.arange(self.meta.nframes) // self.stride, len(self.frame_table) - 1)
+        self.frame_table = self.frame_table.take(hold)
+        self.X_diff = self.X_diff[hold]
+        self.X_ecr = self.X_ecr[hold]
+        self.feature = self.feature[hold]
+
+    def omit_filtered_features(self):
+        self.feature[~self.frame_table.valid] = 0
+        return self.feature
 
     @func.time_it
     def filter_low_quality(self, max_filter_percentage=0.15, threshold=[0.075, 0.08, 0.8]):
-        info_list = self.info_list
-        sort_brightness = sorted(info_list, key=lambda item: item.brightness)
-        sort_sharpness = sorted(info_list, key=lambda item: item.sharpness)
-        sort_uniformity = sorted(info_list, key=lambda item: -item.uniformity)  # max to min
-        for i in range(int(len(info_list) * max_filter_percentage)):
-            if sort_brightness[i].brightness < threshold[0]:
-                sort_brightness[i].valid = False
-                sort_brightness[i].flag += "DARK "
-            if sort_sharpness[i].sharpness < threshold[1]:
-                sort_sharpness[i].valid = False
-                sort_sharpness[i].flag += "BLUR "
-            if sort_uniformity[i].uniformity > threshold[2]:
-                sort_uniformity[i].valid = False
-                sort_uniformity[i].flag += "UNIFORM "
+        table = self.frame_table
+        # mean gradient magnitude grows as 1 / scale on downscaled frames
+        threshold = [threshold[0], threshold[1] / self.scale, threshold[2]]
+        # only the worst max_filter_percentage of the frames by each measure may be rejected by it
+        k = int(len(table) * max_filter_percentage)
+        table.reject(smallest(table.brightness, k) & (table.brightness < threshold[0]), Reject.DARK)
+        table.reject(smallest(table.sharpness, k) & (table.sharpness < threshold[1]), Reject.BLUR)
+        table.reject(smallest(-table.uniformity, k) & (table.uniformity > threshold[2]), Reject.UNIFORM)
 
     @func.time_it
-    def filter_transition(self, max_filter_percentage=0.1, threshold=[0.5, 0, 1]):
-        info_list = self.info_list
+    def filter_transition(self, max_filter_percentage=0.1, threshold=[0.5, 0, 1], ecr_batch=64):
         frame_list = self.frame_list
         img_size = frame_list[0].shape[0] * frame_list[0].shape[1]
 
         # compute the first-order derivative frame-by-frame difference
+        with profiler.span('frame_diff'):
+            v_dist = [0]
+            for i in range(1, len(frame_list)):
+                v_dist.append(cv.norm(frame_list[i] - frame_list[i - 1]))
         v_diff = [0]
         for i in range(1, len(frame_list) - 1):
-            v_diff.append(
-                (cv.norm(frame_list[i] - frame_list[i - 1]) +
-                 cv.norm(frame_list[i + 1] - frame_list[i])) / (2. * img_size)
-            )
+            v_diff.append((v_dist[i] + v_dist[i + 1]) / (2. * img_size))
         v_diff.append(0)
 
-        # compute edge-change-ratio (ECR)
-        dl_sz = 5
-        dl_elm = cv.getStructuringElement(cv.MORPH_CROSS, (2 * dl_sz + 1, 2 * dl_sz + 1), (dl_sz, dl_sz))
+        # compute edge-change-ratio (ECR) from the edge maps of parse_frame_info
+        v_edge = [np.stack(maps) for maps in zip(*self.edge_maps)]
+        self.edge_maps = None
 
-        # Pre-compute edge & edge dilation
-        v_edge = []
-        v_edge_dl = []
-        for i in range(len(frame_list)):
-            gray = to_gray(frame_list[i])
-            theta = cv.threshold(gray, 0, 255, cv.THRESH_BINARY | cv.THRESH_OTSU)[0]
-            v_edge.append(cv.Canny(gray, theta, 1.2 * theta))
-            v_edge_dl.append(cv.dilate(v_edge[i], dl_elm))
-            v_edge[i] -= 254
-            v_edge_dl[i] -= 254
-
-        # Transition detection using ECR (edge change ratio)
-        v_ecr = []
-        for i in range(len(frame_list)):
-            rho_out = 1 - min(1, sum(sum(v_edge[i - 1] * v_edge_dl[i]))) / max(1e-6, sum(sum(v_edge[i - 1])))
-            rho_in = 1 - min(1, sum(sum(v_edge_dl[i - 1] * v_edge[i]))) / max(1e-6, sum(sum(v_edge[i - 1])))
+        # Transition detection using ECR (edge change ratio), frame i against i - 1 in batches
+        height = frame_list[0].shape[0]
+        v_prev = np.roll(np.arange(len(frame_list)), 1)
+        v_ecr = np.zeros(len(frame_list))
+        with profiler.span('ecr'):
+            for b in range(0, len(frame_list), ecr_batch):
+                cur = slice(b, b + ecr_batch)
+                v_ecr[cur] = calc_ecr([maps[v_prev[cur]] for maps in v_edge], [maps[cur] for maps in v_edge], height)
 
-            v_ecr.append(max(rho_out, rho_in))
+        self.X_diff = np.array(v_diff).reshape([len(v_diff), 1]) * self.scale
+        self.X_ecr = np.array(v_ecr).reshape([len(v_ecr), 1])
+        self.flag_transition(max_filter_percentage, threshold)
+        return self.X_diff, self.X_ecr
+
+    def flag_transition(self, max_filter_percentage=0.1, threshold=[0.5, 0, 1]):
+        table = self.frame_table
+        v_diff = self.X_diff[:, 0]
+        v_ecr = self.X_ecr[:, 0]
+        k = int(len(table) * max_filter_percentage)
 
         # CUT detection
-        sorted_cut = sorted(info_list, key=lambda item: -v_diff[item.id])
-        for i in range(int(len(info_list) * max_filter_percentage)):
-            if v_diff[sorted_cut[i].id] >= threshold[0]:
-                sorted_cut[i].valid = False
-                sorted_cut[i].flag += "CUT "
+        table.reject(smallest(-v_diff, k) & (v_diff >= threshold[0]), Reject.CUT)
 
         # TRANSITION detection (cut, fade, dissolve, wipe)
-        sorted_transition = sorted(info_list, key=lambda item: v_ecr[item.id])
-        for i in range(int(len(info_list) * max_filter_percentage)):
-            if v_ecr[sorted_transition[i].id] >= threshold[1]:
-                sorted_transition[i].valid = False
-                sorted_transition[i].flag += "ECR "
-
-        self.X_diff = np.array(v_diff).reshape([len(v_diff), 1])
-        self.X_ecr = np.array(v_ecr).reshape([len(v_ecr), 1])
-        return self.X_diff, self.X_ecr
+        table.reject(smallest(v_ecr, k) & (v_ecr >= threshold[1]), Reject.ECR)
 
     @func.time_it
     def extract_histo_features(self, pyr_level=2, omit_filtered=True, nbins_color=128,
-                               nbins_edge_ori=8, nbins_edge_mag=8):
+                               nbins_edge_ori=8, nbins_edge_mag=8, frame_gradients=True):
         frame_list = self.frame_list
-        info_list = self.info_list
+        valid = self.frame_table.valid
         npatches = 0
         for i in range(pyr_level):
             npatches += 4 ** i
 
         nbins_edge = nbins_edge_mag + nbins_edge_ori
-        color_hist = np.zeros([npatches * 3 * nbins_color, len(frame_list)], dtype=np.float32)
-        edge_hist = np.zeros([npatches * nbins_edge, len(frame_list)], dtype=np.float32)
-
-        for i in tqdm(range(len(frame_list)), desc="Extracting histo features"):
-            if omit_filtered and not info_list[i].valid:
-                continue
+        self.feature = np.zeros([len(frame_list), npatches * (3 * nbins_color + nbins_edge)], dtype=np.float32)
 
-            color_hist[:, i] = calc_pyr_color_hist(frame_list[i], nbins_color, pyr_level)[:, 0]
-            edge_hist[:, i] = calc_pyr_edge_hist(
-                to_gray(frame_list[i]), nbins_edge_ori, nbins_edge_mag, pyr_level)[:, 0]
+        v_idx = []
+        for i in range(len(frame_list)):
+            if omit_filtered and not valid[i]:
+                self.frame_data[i].release()
+            else:
+                v_idx.append(i)
 
-        color_hist = color_hist.T
-        edge_hist = edge_hist.T
+        frames = self.pool.map((self.frame_data[i] for i in v_idx), calc_histo_features,
+                               (pyr_level, nbins_color, nbins_edge_ori, nbins_edge_mag, frame_gradients))
+        for i, (data, feature) in zip(v_idx, tqdm(frames, total=len(v_idx), desc="Extracting histo features")):
+            self.feature[i] = feature
+            # last stage to use the derived images of this frame
+            data.release()
+        profiler.count('features', len(v_idx))
 
-        self.feature = np.concatenate([color_hist, edge_hist], axis=1)
         logger.info(f"Feature shape: {self.feature.shape}")
         return self.feature
 
     @func.time_it
     def post_process(self, min_shot_len=40):  # no gfl
-        frame_list = self.frame_list
-        info_list = self.info_list
-        X_diff = self.X_diff
-
-        start_idx = -1
-        end_idx = -1
-        shotlen = -1
+        table = self.frame_table
+        v_diff = self.X_diff[:, 0]
         max_shot_len = min_shot_len * 3
 
-        for i in tqdm(range(len(frame_list)), desc="Post process"):
-            if start_idx < 0 and info_list[i].valid:
-                start_idx = i
-            if start_idx >= 0 and (not info_list[i].valid or i + 1 == len(frame_list)):
-                end_idx = i
-                shotlen = end_idx - start_idx + 1
-                if shotlen >= max_shot_len:
-                    njumps = int(np.floor(shotlen / min_shot_len))
-                    v_diff = X_diff[start_idx:end_idx + 1]
-                    jump = sbd_heuristic(v_diff, njumps, min_shot_len)
-                    # logger.debug(start_idx, end_idx, jump)
-                    for k in range(len(jump)):
-                        info_list[start_idx + jump[k] - 1].valid = False
-                        info_list[start_idx + jump[k] - 1].flag += "[GFL] "
-
-                start_idx = -1
-                end_idx = -1
+        # a run of valid frames is taken up to and including the invalid frame that ends it
+        starts, ends = func.find_runs(table.valid)
+        ends = np.minimum(ends + 1, len(table) - 1)
+        long = ends - starts + 1 >= max_shot_len
+        for start_idx, end_idx in zip(starts[long].tolist(), ends[long].tolist()):
+            shotlen = end_idx - start_idx + 1
+            njumps = int(np.floor(shotlen / min_shot_len))
+            jump = sbd_heuristic(v_diff[start_idx:end_idx + 1], njumps, min_shot_len)
+            # logger.debug(start_idx, end_idx, jump)
+            table.reject(start_idx + np.array(jump, dtype=int) - 1, Reject.GFL)
 
     @func.time_it
     def filter_redundant_and_obtain_subshots(self):
-        valid_frame = [item for id, item in enumerate(self.frame_list) if self.info_list[id].valid]
-        nfrm_valid = len(valid_frame)
+        table = self.frame_table
+        nfrm_valid = np.count_nonzero(table.valid)
         if nfrm_valid == 0:
             return
 
-        km_data = np.ndarray([nfrm_valid, self.feature.shape[1]], dtype=self.feature.dtype)
-        v_idxmap = np.zeros([nfrm_valid], dtype=int)
-
-        row = 0
-        for i in range(len(self.frame_list)):
-            if self.info_list[i].valid:
-                km_data[row] = np.copy(self.feature[row])
-                v_idxmap[row] = i
-                row += 1
+        # the first nfrm_valid rows, by position rather than frame index, as the former row-by-row copy took them
+        km_data = self.feature[:nfrm_valid].copy()
+        v_idxmap = np.flatnonzero(table.valid)
 
-        # print(km_data.shape)
-        # print(self.feature.shape)
-        # print(np.max(km_data))
-        # print(np.min(km_data))
         ncluster = min(nfrm_valid // 2, len(self.ranges))
-        km_lbl, km_ctr = func.perform_kmeans(km_data, ncluster)
-
-        v_frm_clusterid = -np.ones(len(self.frame_list))
-        for i in range(km_lbl.shape[0]):
-            v_frm_clusterid[v_idxmap[i]] = km_lbl[i]
-
-        for shotid, shot in enumerate(self.ranges):
-            sb0 = shot.start
-            sb1 = shot.end
-
-            ssb0 = -1
-            ssb1 = -1
-            lbl = -1
-            for j in range(sb0, sb1 + 1):
-                if self.info_list[j].valid:
-                    if ssb0 < 0:
-                        ssb0 = j
-                        lbl = v_frm_clusterid[j]
-                    ssb1 = j
-                if ssb0 >= 0 and (v_frm_clusterid[j] != lbl or j == sb1):
-                    diff_min_idx = -1
-                    diff_min_val = sys.float_info.max
-                    for k in range(ssb0, ssb1 + 1):
-                        diff_k = self.X_diff[k]
-                        if diff_k < diff_min_val:
-                            diff_min_idx = k
-                            diff_min_val = diff_k
-
-                    r = Range(ssb0, ssb1)
-                    r.v_idx.append(diff_min_idx)
-                    self.ranges[shotid].v_idx.append(diff_min_idx)
-                    self.ranges[shotid].v_range.append(r)
-
-                    for k in range(ssb0, ssb1 + 1):
-                        if k != diff_min_idx:
-                            self.info_list[k].valid = False
-                            self.info_list[k].flag += "[Redundant] "
-
-                    ssb0 = ssb1 = lbl = -1
-            sb0 = sb1 = -1
+        km_lbl, km_ctr = func.perform_kmeans(km_data, ncluster, method=self.opt.kmeans,
+                                             batch_size=self.opt.kmeans_batch, max_samples=self.opt.kmeans_samples)
+
+        v_frm_clusterid = -np.ones(len(table))
+        v_frm_clusterid[v_idxmap] = km_lbl[:, 0]
+
+        # shots are runs of valid frames, so all their frames are labelled. A sub-shot runs from its first frame
+        # up to and including the next frame labelled differently, or to the end of the shot
+        shot_starts = self.ranges.shots['start']
+        shot_ends = self.ranges.shots['end']
+        in_shot = func.runs_mask(shot_starts, shot_ends, len(table))
+        change = np.zeros(len(table), dtype=bool)
+        change[1:] = v_frm_clusterid[1:] != v_frm_clusterid[:-1]
+        change &= in_shot
+        change[shot_starts] = False
+
+        # the frame after a sub-shot starts the next one whatever its label, so out of consecutive label changes
+        # only every other one ends a sub-shot
+        run_starts, run_ends = func.find_runs(change)
+        v_change = np.flatnonzero(change)
+        v_change = v_change[(v_change - np.repeat(run_starts, run_ends - run_starts + 1)) % 2 == 0]
+        sub_end = np.zeros(len(table), dtype=bool)
+        sub_end[v_change] = True
+        sub_end[shot_ends] = True
+        sub_ends = np.flatnonzero(sub_end)
+        sub_start = np.zeros(len(table), dtype=bool)
+        sub_start[shot_starts] = True
+        v_next = sub_ends[sub_ends + 1 < len(table)] + 1
+        sub_start[v_next[in_shot[v_next]]] = True
+        sub_starts = np.flatnonzero(sub_start)
+
+        # the frame of least difference to its neighbours represents each sub-shot, the others are redundant
+        v_key = func.segment_argmin(self.X_diff[:, 0], sub_starts, sub_ends)
+        v_shotid = np.searchsorted(shot_starts, sub_starts, side='right') - 1
+        self.ranges.add_subshots(sub_starts, sub_ends, v_key, v_shotid)
+
+        redundant = in_shot
+        redundant[v_key] = False
+        table.reject(redundant, Reject.REDUNDANT)
 
     def update_shot_range(self, min_shot_len):
-        frame_list = self.frame_list
-        info_list = self.info_list
-        ranges = []
-        sb0 = sb1 = -1
-        for i in range(len(frame_list)):
-            if info_list[i].valid:
-                if sb0 < 0:
-                    sb0 = i
-                sb1 = i
-
-            if sb0 >= 0 and sb1 >= 0 and (not info_list[i].valid or i + 1 == len(frame_list)):
-                # logger.debug(sb0, sb1)
-                if sb1 - sb0 + 1 > min_shot_len:
-                    ranges.append(ShotRange(sb0, sb1))
-                else:
-                    for j in range(sb0, sb1 + 1):
-                        info_list[j].valid = False
-                        info_list[j].flag += "SHORT "
-                sb0 = sb1 = -1
-        self.ranges = ranges
-        return ranges
+        table = self.frame_table
+        starts, ends = func.find_runs(table.valid)
+        short = ends - starts + 1 <= min_shot_len
+        table.reject(func.runs_mask(starts[short], ends[short], len(table)), Reject.SHORT)
+        self.ranges = ShotTable.from_shots(starts[~short], ends[~short])
+        return self.ranges
 
     @func.time_it
     def parse_frame_info(self):
         frame_list = self.frame_list
-        info_list = []
-        for idx, bgr in enumerate(tqdm(frame_list, desc="Parse frame info")):
-            gray = to_gray(bgr)
+        stats_list = np.zeros([len(frame_list), 3], dtype=np.float64)
+        # edge maps (bit-packed edges & dilation, per-column counts) are taken in the same pass, so the blurred
+        # frame is only held while its frame is analysed
+        self.edge_maps = []
+        frames = self.pool.map(self.frame_data, calc_list_frame, (calc_dilation_element(self.scale),))
+        for idx, (data, (stats, edges)) in enumerate(tqdm(frames, total=len(frame_list), desc="Parse frame info")):
+            stats_list[idx] = stats
+            self.edge_maps.append(edges)
+            data.release()
+        self.frame_table = FrameTable(stats_list)
 
-            info = FrameInfo(
-                idx,
-                calc_brightness(bgr),
-                calc_sharpness(gray),
-                calc_uniformity(gray)
-            )
-            # logger.debug(info)
+        # compute screen chat scores
+        assert len(frame_list) == self.nframes_analysed
+        self.parse_chat_scores()
 
-            info_list.append(info)
-        self.info_list = info_list
+        return self.frame_table
 
-        # compute screen chat scores
-        assert len(frame_list) == self.meta.nframes
+    @func.time_it
+    def parse_chat_scores(self):
         chat_window = (int(-self.meta.fps * self.opt.chat_window[1]),
                        int(-self.meta.fps * self.opt.chat_window[0]))    # reverse here to transform from frame view to chat view
         chat_pdf = np.zeros(shape=(chat_window[1] - chat_window[0]), dtype=np.float32)
@@ -557,71 +1050,80 @@ class VideoParser:
         for i in range(0, chat_window[1]):
             chat_pdf[i] = func.regularized_gaussian_distribution_0_1(i / chat_window[1])
         chat_pdf = func.normalize_pdf(chat_pdf)
-        pdf_indexes = [0] * len(frame_list)
-        pdf_index = 1
-        chat_pdfs = [chat_pdf]
-        for i in tqdm(range(self.meta.nframes), 'Init chat pdf'):
-            if i + chat_window[0] < 0 or i + chat_window[1] >= self.meta.nframes:
-                chat_pdf_new = chat_pdf.copy()
-                for j in range(chat_window[0], chat_window[1]):
-                    if i + j < 0 or i + j >= self.meta.nframes:
-                        chat_pdf_new[j] = 0.0
-                chat_pdf_new = func.normalize_pdf(chat_pdf_new)
-                chat_pdfs.append(chat_pdf_new)
-                pdf_indexes[i] = pdf_index
-                pdf_index += 1
-            else:
-                pdf_indexes[i] = 0
-
-        with open(os.path.join(os.path.dirname(self.opt.video_file), 'chat.json'), 'r', encoding='utf-8') as f:
-            chats = json.load(f)
-        chat_scores = np.zeros(shape=(len(frame_list)), dtype=np.float32)
-        for chat in tqdm(chats, 'Compute chat scores'):
-            chat_frame_index = min(int(chat['time'] * self.meta.fps + 0.5), self.meta.nframes - 1)
-            # logger.debug(f'{chat_frame_index}: {chat["text"]}')
-            chat_pdf = chat_pdfs[pdf_indexes[chat_frame_index]]
-            for i in range(max(chat_window[0], -chat_frame_index), min(chat_window[1], self.meta.nframes - chat_frame_index)):
-                chat_scores[chat_frame_index + i] += chat_pdf[i]
+
+        chat_times = load_chat_times(os.path.dirname(self.opt.video_file))
+        chat_scores = self.calc_chat_scores(chat_times, chat_pdf, chat_window, self.meta.fps, self.meta.nframes)
         self.chat_scores = chat_scores / np.max(chat_scores)
 
         # max_index = np.argmax(chat_scores)
         # logger.debug(f'chat_scores: {chat_scores.shape}, {chat_scores[max_index]}')
-        # cv.imshow(f'Highest chat score: frame {max_index}', frame_list[max_index])
+        # cv.imshow(f'Highest chat score: frame {max_index}', self.frame_list[max_index])
         # cv.waitKey(0)
 
-        return info_list
+        return self.chat_scores
+
+    @staticmethod
+    def calc_chat_scores(chat_times, chat_pdf, chat_window, fps, nframes):
+        """
+        Spread every chat message over the frames of its window, weighted by chat_pdf (indexed by the frame
+        offset, negative offsets wrap to the end). Messages near either end of the video use the pdf cut to the
+        frames that exist, renormalized.
+        """
+        w0, w1 = chat_window
+        chat_frame_index = np.minimum((chat_times * fps + 0.5).astype(np.int64), nframes - 1)
+        counts = np.bincount(chat_frame_index, minlength=nframes).astype(np.float64)
+        offsets = np.arange(w0, w1)
+        kernel = chat_pdf[offsets % len(chat_pdf)].astype(np.float64)
+
+        # messages whose window fits in the video share one pdf: a plain convolution of the per-frame counts
+        frames = np.arange(nframes)
+        boundary = (frames + w0 < 0) | (frames + w1 >= nframes)
+        inner = np.where(boundary, 0.0, counts)
+        chat_scores = np.convolve(inner, kernel)[-w0:nframes - w0]
+
+        # messages close to either end each get the pdf cut to the existing frames and renormalized
+        edge = np.flatnonzero(boundary & (counts > 0))
+        if len(edge) > 0:
+            targets = edge[:, None] + offsets[None, :]
+            inside = (targets >= 0) & (targets < nframes)
+            pdfs = np.where(inside, chat_pdf[offsets % len(chat_pdf)][None, :], np.float32(0.0))
+            pdfs = pdfs / np.sum(pdfs, axis=1, keepdims=True)
+            np.add.at(chat_scores, targets[inside], (counts[edge, None] * pdfs)[inside])
+
+        return chat_scores.astype(np.float32)
+
+    def _analysed_frame(self, idx):
+        # frame ids are in original-frame units after expand_stride, frame_list holds the analysed frames only
+        return self.frame_list[idx // self.stride]
 
     def debug_show_invalid(self):
-        info_list = self.info_list
-        frame_list = self.frame_list
-        for item in info_list:
+        frame_table = self.frame_table
+        for item in frame_table:
             if not item.valid:
                 logger.debug(item)
-                cv.imshow(f"Invalid {item.id}", frame_list[item.id])
+                cv.imshow(f"Invalid {item.id}", self._analysed_frame(item.id))
                 cv.waitKey()
 
     def debug_show_certain_invalid(self, key):
-        info_list = self.info_list
-        frame_list = self.frame_list
-        for item in info_list:
+        frame_table = self.frame_table
+        for item in frame_table:
             if not item.valid and key in item.flag:
                 logger.debug(item)
-                cv.imshow(f"Invalid {item.id}", frame_list[item.id])
+                cv.imshow(f"Invalid {item.id}", self._analysed_frame(item.id))
                 cv.waitKey()
 
     def debug_show_valid(self):
-        info_list = self.info_list
-        frame_list = self.frame_list
-        for item in info_list:
+        frame_table = self.frame_table
+        for item in frame_table:
             if item.valid:
                 logger.debug(item)
-                cv.imshow(f"Valid {item.id}", frame_list[item.id])
+                cv.imshow(f"Valid {item.id}", self._analysed_frame(item.id))
                 cv.waitKey()
 
     def debug_show_ranges(self):
         for sr in self.ranges:
             for idx in sr.v_idx:
-                logger.debug(self.info_list[idx])
-                cv.imshow(f"Range selected {idx}", self.frame_list[idx])
+                logger.debug(self.frame_table[idx])
+                cv.imshow(f"Range selected {idx}", self._analysed_frame(idx))
                 cv.waitKey()
                 cv.destroyWindow(f"Range selected {idx}")
\ No newline at end of file